@@ -9,7 +9,8 @@ import re
 import time
 import json
 from datetime import datetime
-from difflib import SequenceMatcher
+from collections import Counter
+from functools import lru_cache
 from groq import Groq
 
 # ============================================================
@@ -372,6 +373,7 @@ DEFAULTS = {
     "news_analysis": None,
     "ai_qa_history": [],
     "_audio_widget_key": 0,
+    "_vocab_index": None,
 }
 
 for k, v in DEFAULTS.items():
@@ -421,8 +423,18 @@ def fmt_duration(seconds):
     if m: parts.append(f"{m}m")
     parts.append(f"{sec}s"); return " ".join(parts)
 
+# Tabla precalculada para Latin-1 y Latin Extendido-A: cada carácter va a su forma sin tildes
+# y en minúscula. Lo que quede fuera (otros alfabetos, marcas sueltas) usa el camino NFD.
+_FOLD_TABLE = {c: ''.join(ch for ch in unicodedata.normalize('NFD', chr(c)) if unicodedata.category(ch) != 'Mn').lower()
+               for c in range(0x250)}
+_FOLD_TABLE = {c: f for c, f in _FOLD_TABLE.items() if f != chr(c)}
+_FOLD_OUTSIDE = re.compile(r"[^\x00-\u024f]")
+
+@lru_cache(maxsize=131072)
 def norm(text):
     if not text: return ""
+    if text.isascii(): return text.lower().strip()
+    if not _FOLD_OUTSIDE.search(text): return text.translate(_FOLD_TABLE).strip()
     t = unicodedata.normalize('NFD', text)
     return ''.join(c for c in t if unicodedata.category(c) != 'Mn').lower().strip()
 
@@ -641,25 +653,78 @@ def determine_search_mode(query, segments):
             if pattern.search(seg.get("text", "")): return pattern, "exacta"
     return pattern, "similar"
 
-def _fuzzy_highlight(text, q_words, fuzzy_thresh):
+def _token_core(tok): return re.sub(r'^\W+|\W+$', '', tok)
+
+def _edge_grams(t):
+    p = f"^{t}$"; return {p[k:k+3] for k in range(len(p) - 2)}
+
+def bounded_edit_distance(a, b, max_d):
+    """Levenshtein limitado a la banda |i - j| <= max_d; por encima de max_d devuelve max_d + 1."""
+    la, lb, big = len(a), len(b), max_d + 1
+    if abs(la - lb) > max_d: return big
+    if a == b: return 0
+    prev = [j if j <= max_d else big for j in range(lb + 1)]
+    for i in range(1, la + 1):
+        ca, lo, hi = a[i-1], max(1, i - max_d), min(lb, i + max_d)
+        cur = [big] * (lb + 1); cur[0] = row_min = i if i <= max_d else big
+        for j in range(lo, hi + 1):
+            v = prev[j-1] if ca == b[j-1] else prev[j-1] + 1
+            if prev[j] + 1 < v: v = prev[j] + 1
+            if cur[j-1] + 1 < v: v = cur[j-1] + 1
+            if v > big: v = big
+            cur[j] = v
+            if v < row_min: row_min = v
+        if row_min > max_d: return big
+        prev = cur
+    return prev[lb]
+
+class VocabIndex:
+    """Vocabulario normalizado de la transcripción con un índice de trigramas (con bordes ^ $).
+    similar() solo mide la distancia de edición de las palabras que comparten trigramas con la consulta."""
+    def __init__(self, segments):
+        self.segments, self.n_segments = segments, len(segments)
+        self.vocab = {w for seg in segments for w in (norm(_token_core(t)) for t in seg.get("text", "").split()) if len(w) >= 3}
+        self.grams = {}
+        for w in self.vocab:
+            for g in _edge_grams(w): self.grams.setdefault(g, []).append(w)
+
+    def similar(self, q_words, fuzzy_thresh):
+        """Palabras del vocabulario con similitud 1 - d/max(len) >= fuzzy_thresh con alguna de q_words."""
+        out = set()
+        for qw in map(_token_core, q_words):
+            if len(qw) < 3: continue
+            # Con d ediciones se pierden como mucho 3d trigramas; se exige al menos uno común
+            max_d = int((1 - fuzzy_thresh) * len(qw) / fuzzy_thresh + 1e-9); qg = _edge_grams(qw)
+            hits = Counter(w for g in qg for w in self.grams.get(g, ()))
+            need = max(1, len(qg) - 3 * max_d)
+            for w, n in hits.items():
+                if n < need or abs(len(w) - len(qw)) > max_d: continue
+                d = bounded_edit_distance(qw, w, max_d)
+                if d <= max_d and 1 - d / max(len(qw), len(w)) >= fuzzy_thresh: out.add(w)
+        return out
+
+def vocab_index(segments):
+    """Índice del vocabulario guardado en la sesión; se rehace solo si cambia la lista de segmentos."""
+    vi = st.session_state.get("_vocab_index")
+    if vi is None or vi.segments is not segments or vi.n_segments != len(segments):
+        vi = st.session_state._vocab_index = VocabIndex(segments)
+    return vi
+
+def _fuzzy_highlight(text, similar):
     found = False; result = text; seen = set()
     for tok in re.findall(r"\S+", text):
-        core = re.sub(r'^\W+|\W+$', '', tok)
-        wn = norm(core)
-        if not wn or len(wn) < 3 or tok in seen: continue
-        best = max((SequenceMatcher(None, qw, wn).ratio() for qw in q_words if len(qw) >= 3), default=0.0)
-        if best >= fuzzy_thresh:
-            seen.add(tok); found = True
-            result = result.replace(tok, f"<mark class='mk-similar'>{tok}</mark>", 1)
+        if tok in seen or norm(_token_core(tok)) not in similar: continue
+        seen.add(tok); found = True
+        result = result.replace(tok, f"<mark class='mk-similar'>{tok}</mark>", 1)
     return found, result
 
-def highlight_and_check(text, pattern, q_words, fuzzy_thresh, mode):
+def highlight_and_check(text, pattern, similar, mode):
     if mode == "exacta":
         if pattern and pattern.search(text):
             return True, pattern.sub(lambda m: f"<mark class='mk-exact'>{m.group()}</mark>", text)
         return False, text
     elif mode == "similar":
-        return _fuzzy_highlight(text, q_words, fuzzy_thresh)
+        return _fuzzy_highlight(text, similar)
     return False, text
 
 
@@ -824,6 +889,7 @@ def main_app():
 
         if query:
             pattern, mode = determine_search_mode(query, segs)
+            similar = vocab_index(segs).similar(q_words, fuzzy_t) if mode == "similar" else set()
             match_count = 0
 
             for i, seg in enumerate(segs):
@@ -831,7 +897,7 @@ def main_app():
                 ts = fmt_time(start_sec)
                 text_content = seg.get("text", "")
                 
-                matched, html_formatted = highlight_and_check(text_content, pattern, q_words, fuzzy_t, mode)
+                matched, html_formatted = highlight_and_check(text_content, pattern, similar, mode)
                 if matched:
                     match_count += 1
                     if first_match_idx is None:
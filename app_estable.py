@@ -3,12 +3,27 @@ import streamlit.components.v1 as components
 import os
 import tempfile
 import unicodedata
-from groq import Groq
+import numpy as np
+from groq import Groq, RateLimitError
 from difflib import SequenceMatcher
 import re
 import json
 import time
-from datetime import datetime
+import sys
+import glob
+import argparse
+import shutil
+import string
+import subprocess
+import hashlib
+import bisect
+import threading
+import sqlite3
+from contextlib import closing
+from collections import Counter
+from functools import lru_cache
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIGURACIÓN ---
 st.set_page_config(
@@ -443,8 +458,10 @@ AUDIO_DEFAULTS = {
 GLOBAL_DEFAULTS = {
     "authenticated": False, "pydub_available": None, "chat_history": [],
     "search_results": None, "last_search_query": "", "global_search_results": None,
-    "last_global_query": "", "audio_history": [], "active_audio_id": None,
+    "last_global_query": "", "active_audio_id": None,
     "_search_pending": False, "_global_search_pending": False, "_audio_widget_key": 0,
+    "my_jobs": [], "_opened_jobs": [], "_search_index": None, "_partial_index": None, "hist_page": 0,
+    "_analysis_errors": {},
 }
 
 for k, v in {**AUDIO_DEFAULTS, **GLOBAL_DEFAULTS}.items():
@@ -455,35 +472,157 @@ for k, v in {**AUDIO_DEFAULTS, **GLOBAL_DEFAULTS}.items():
 # ============================================================
 # HISTORIAL
 # ============================================================
-MAX_HISTORY = 6
-
-def history_save_current():
+# Historial persistente en SQLite: la tabla audios guarda los metadatos y el estado
+# ligero de cada audio; los segmentos van en su propia tabla y solo se leen al abrirlo.
+# Los segmentos corregidos se copian por trigger a search_rows, indexada con FTS5 sin tildes
+# (search_fts) para la búsqueda global; las bases antiguas se indexan al abrirlas.
+HISTORY_DB = os.environ.get("TRANSCRIPTOR_DB") or os.path.join(
+    os.path.expanduser("~"), ".local", "share", "transcriptor", "historial.db")
+HISTORY_BAR_LIMIT = 6
+HISTORY_PAGE = 25
+SEGMENT_KINDS = {"transcript_segments": "raw", "corrected_segments": "corrected"}
+_history_ready = False
+
+def history_db():
+    global _history_ready
+    if not _history_ready: os.makedirs(os.path.dirname(HISTORY_DB) or ".", exist_ok=True)
+    con = sqlite3.connect(HISTORY_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    if not _history_ready:
+        con.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS audios (
+                id TEXT PRIMARY KEY, filename TEXT, created_at TEXT, saved_at TEXT,
+                duration REAL DEFAULT 0, word_count INTEGER DEFAULT 0, state TEXT);
+            CREATE INDEX IF NOT EXISTS audios_created ON audios(created_at);
+            CREATE TABLE IF NOT EXISTS segments (
+                audio_id TEXT NOT NULL, kind TEXT NOT NULL, idx INTEGER NOT NULL,
+                start_s REAL, end_s REAL, text TEXT, extra TEXT,
+                PRIMARY KEY (audio_id, kind, idx)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS search_rows (
+                id INTEGER PRIMARY KEY, audio_id TEXT NOT NULL, idx INTEGER NOT NULL,
+                start_s REAL, end_s REAL, text TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS search_rows_seg ON search_rows(audio_id, idx);
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+                text, content='search_rows', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2');
+            CREATE TRIGGER IF NOT EXISTS segments_ai AFTER INSERT ON segments WHEN new.kind = 'corrected' BEGIN
+                INSERT INTO search_rows (audio_id, idx, start_s, end_s, text)
+                VALUES (new.audio_id, new.idx, new.start_s, new.end_s, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS segments_ad AFTER DELETE ON segments WHEN old.kind = 'corrected' BEGIN
+                DELETE FROM search_rows WHERE audio_id = old.audio_id AND idx = old.idx;
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_rows_ai AFTER INSERT ON search_rows BEGIN
+                INSERT INTO search_fts (rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_rows_ad AFTER DELETE ON search_rows BEGIN
+                INSERT INTO search_fts (search_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END;
+            INSERT INTO search_rows (audio_id, idx, start_s, end_s, text)
+                SELECT audio_id, idx, start_s, end_s, text FROM segments
+                WHERE kind = 'corrected' AND NOT EXISTS (SELECT 1 FROM search_rows);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, audio_id TEXT, filename TEXT, path TEXT, params TEXT,
+                status TEXT, log TEXT DEFAULT '', error TEXT, created_at TEXT, updated_at TEXT, boot TEXT);
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, updated_at);
+        """)
+        if "boot" not in {r["name"] for r in con.execute("PRAGMA table_info(jobs)")}:
+            con.execute("ALTER TABLE jobs ADD COLUMN boot TEXT")
+        _history_ready = True
+    return con
+
+def _segment_row(aid, kind, i, seg):
+    extra = {k: v for k, v in seg.items() if k not in ("start", "end", "text") and not k.startswith("_")}
+    return (aid, kind, i, float(seg.get("start", 0)), float(seg.get("end", 0)), seg.get("text", ""),
+            json.dumps(extra, ensure_ascii=False) if extra else None)
+
+def _segment_from_row(row):
+    seg = {"start": row["start_s"], "end": row["end_s"], "text": row["text"]}
+    if row["extra"]: seg.update(json.loads(row["extra"]))
+    return seg
+
+def history_save_current(with_segments=False):
     aid = st.session_state.active_audio_id
     if not aid or not st.session_state.transcript_text: return
-    snapshot = {k: st.session_state[k] for k in AUDIO_DEFAULTS}
-    snapshot["id"] = aid; snapshot["saved_at"] = datetime.now().isoformat()
-    hist = st.session_state.audio_history
-    for i, h in enumerate(hist):
-        if h["id"] == aid: hist[i] = snapshot; return
-    if len(hist) >= MAX_HISTORY: hist.pop(0)
-    hist.append(snapshot)
+    history_save(aid, {k: st.session_state[k] for k in AUDIO_DEFAULTS}, with_segments)
+
+def history_save(aid, data, with_segments=False):
+    """Guarda un audio a partir de un dict con las claves de AUDIO_DEFAULTS (no usa la sesión)."""
+    state = {k: data.get(k, v) for k, v in AUDIO_DEFAULTS.items() if k not in SEGMENT_KINDS}
+    now = datetime.now().isoformat()
+    with closing(history_db()) as con, con:
+        con.execute("INSERT INTO audios (id, filename, created_at, saved_at, duration, word_count, state) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET filename = excluded.filename, "
+                    "saved_at = excluded.saved_at, duration = excluded.duration, "
+                    "word_count = excluded.word_count, state = excluded.state",
+                    (aid, data.get("uploaded_filename") or "audio", now, now,
+                     get_audio_duration(data.get("corrected_segments") or []),
+                     len((data.get("transcript_text") or "").split()),
+                     json.dumps(state, ensure_ascii=False)))
+        if with_segments:
+            con.execute("DELETE FROM segments WHERE audio_id = ?", (aid,))
+            for key, kind in SEGMENT_KINDS.items():
+                con.executemany("INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (_segment_row(aid, kind, i, seg) for i, seg in enumerate(data.get(key) or [])))
+
+def _name_filter(name):
+    if not name: return "", ()
+    return " WHERE filename LIKE ? ESCAPE '\\'", ("%" + re.sub(r"([%_\\])", r"\\\1", name) + "%",)
+
+def history_list(limit=None, offset=0, name=None):
+    """Metadatos de los audios guardados, del más reciente al más antiguo (sin segmentos);
+    offset y name (parte del nombre del archivo) sirven para paginar y filtrar el historial."""
+    where, args = _name_filter(name)
+    with closing(history_db()) as con:
+        rows = con.execute("SELECT id, filename, created_at, duration, word_count FROM audios" + where +
+                           " ORDER BY created_at DESC LIMIT ? OFFSET ?", (*args, limit or -1, offset)).fetchall()
+    return [{"id": r["id"], "uploaded_filename": r["filename"], "created_at": r["created_at"],
+             "duration": r["duration"] or 0, "word_count": r["word_count"] or 0} for r in rows]
+
+def history_count(name=None):
+    where, args = _name_filter(name)
+    with closing(history_db()) as con: return con.execute("SELECT COUNT(*) FROM audios" + where, args).fetchone()[0]
+
+def history_state(audio_id):
+    with closing(history_db()) as con:
+        row = con.execute("SELECT state FROM audios WHERE id = ?", (audio_id,)).fetchone()
+    return json.loads(row["state"]) if row and row["state"] else None
+
+def history_segments(audio_id, kind="corrected"):
+    with closing(history_db()) as con:
+        rows = con.execute("SELECT start_s, end_s, text, extra FROM segments WHERE audio_id = ? AND kind = ? "
+                           "ORDER BY idx", (audio_id, kind)).fetchall()
+    return [_segment_from_row(r) for r in rows]
 
 def history_load(audio_id):
-    for h in st.session_state.audio_history:
-        if h["id"] == audio_id:
-            for k in AUDIO_DEFAULTS: st.session_state[k] = h.get(k, AUDIO_DEFAULTS[k])
-            st.session_state.active_audio_id = audio_id
-            st.session_state.chat_history = []
-            st.session_state.search_results = None
-            st.session_state.last_search_query = ""
-            return True
-    return False
+    state = history_state(audio_id)
+    if state is None: return False
+    for k in AUDIO_DEFAULTS:
+        if k in SEGMENT_KINDS: st.session_state[k] = history_segments(audio_id, SEGMENT_KINDS[k]) or None
+        else: st.session_state[k] = state.get(k, AUDIO_DEFAULTS[k])
+    st.session_state.active_audio_id = audio_id
+    st.session_state.chat_history = []
+    st.session_state._analysis_errors = {}
+    st.session_state.search_results = None
+    st.session_state.last_search_query = ""
+    return True
+
+def history_delete(audio_id):
+    with closing(history_db()) as con, con:
+        # El audio subido solo sirve para este resultado y para reintentar su trabajo
+        for r in con.execute("SELECT DISTINCT path FROM jobs WHERE audio_id = ? AND path IS NOT NULL "
+                             "AND status NOT IN (?, ?)", (audio_id, *JOB_ACTIVE)).fetchall():
+            _drop_upload(con, r["path"])
+        con.execute("DELETE FROM segments WHERE audio_id = ?", (audio_id,))
+        con.execute("DELETE FROM audios WHERE id = ?", (audio_id,))
 
 def history_new_id(): return f"audio_{int(time.time() * 1000)}"
 
 def reset_current_audio():
     for k, v in AUDIO_DEFAULTS.items(): st.session_state[k] = v
     st.session_state.chat_history = []
+    st.session_state._analysis_errors = {}
     st.session_state.search_results = None
     st.session_state.last_search_query = ""
 
@@ -498,7 +637,6 @@ def check_pydub_ffmpeg():
         from pydub import AudioSegment
     except ImportError:
         st.session_state.pydub_available = False; return False, "pydub no instalado"
-    import shutil
     ffmpeg_bin = shutil.which("ffmpeg")
     if not ffmpeg_bin:
         for c in ["/usr/bin/ffmpeg", "/usr/local/bin/ffmpeg"]:
@@ -529,11 +667,31 @@ def fmt_duration(seconds):
     if m: parts.append(f"{m}m")
     parts.append(f"{sec}s"); return " ".join(parts)
 
+# Tabla precalculada para Latin-1 y Latin Extendido-A: cada carácter va a su forma sin tildes
+# y en minúscula. Lo que quede fuera (otros alfabetos, marcas sueltas) usa el camino NFD.
+_FOLD_TABLE = {c: ''.join(ch for ch in unicodedata.normalize('NFD', chr(c)) if unicodedata.category(ch) != 'Mn').lower()
+               for c in range(0x250)}
+_FOLD_TABLE = {c: f for c, f in _FOLD_TABLE.items() if f != chr(c)}
+_FOLD_OUTSIDE = re.compile(r"[^\x00-\u024f]")
+
+@lru_cache(maxsize=131072)
 def norm(text):
     if not text: return ""
+    if text.isascii(): return text.lower().strip()
+    if not _FOLD_OUTSIDE.search(text): return text.translate(_FOLD_TABLE).strip()
     t = unicodedata.normalize('NFD', text)
     return ''.join(c for c in t if unicodedata.category(c) != 'Mn').lower().strip()
 
+def seg_norm(seg):
+    """norm() del texto del segmento, guardado en el propio segmento como (texto, normalizado);
+    si el texto cambia (corrección, vocabulario) se recalcula. Las claves con _ no se exportan."""
+    t = seg.get("text", ""); c = seg.get("_norm")
+    if not c or c[0] != t: c = seg["_norm"] = (t, norm(t))
+    return c[1]
+
+def public_segments(segments):
+    return [{k: v for k, v in s.items() if not k.startswith("_")} for s in segments]
+
 def highlight_html(text, query):
     if not query or not text: return text
     result = text; pat = re.compile(re.escape(query), re.IGNORECASE)
@@ -567,6 +725,40 @@ def get_audio_duration(segments):
     if not segments: return 0
     return max(float(seg.get("end", 0)) for seg in segments)
 
+def fmt_srt_time(seconds):
+    s = float(seconds)
+    return f"{int(s//3600):02d}:{int((s%3600)//60):02d}:{s%60:06.3f}"
+
+def _srt_cues(seg, max_chars):
+    """Parte un segmento largo en subtítulos con los tiempos exactos de sus palabras."""
+    words, text = seg.get("words"), seg.get("text", "")
+    if not words or len(text) <= max_chars or len(words) != len(text.split()):
+        return [(seg.get("start", 0), seg.get("end", 0), text)]
+    cues, cur = [], []
+    for (ws, we, _), tok in zip(words, text.split()):
+        if cur and len(" ".join(c[2] for c in cur)) + 1 + len(tok) > max_chars:
+            cues.append((cur[0][0], cur[-1][1], " ".join(c[2] for c in cur))); cur = []
+        cur.append((ws, we, tok))
+    if cur: cues.append((cur[0][0], cur[-1][1], " ".join(c[2] for c in cur)))
+    return cues
+
+def build_srt(segments, max_chars=84):
+    srt, n = [], 0
+    for seg in segments:
+        for s, e, text in _srt_cues(seg, max_chars):
+            n += 1
+            srt.extend([f"{n}", f"{fmt_srt_time(s)} --> {fmt_srt_time(e)}", text, ""])
+    return "\n".join(srt)
+
+def build_export_json(filename, text, segments, coverage, entities=None, lead=None):
+    """Mismo formato que el JSON completo de la pestaña Exportar."""
+    return {
+        "filename": filename, "date": datetime.now().isoformat(),
+        "duration_seconds": get_audio_duration(segments), "word_count": len(text.split()),
+        "coverage_percent": coverage, "entities": entities,
+        "lead": lead, "full_text": text, "segments": public_segments(segments)
+    }
+
 def build_timestamped_transcript(segments):
     return "\n".join(f"[{fmt_time(float(seg.get('start', 0)))}] {seg.get('text', '').strip()}"
                      for seg in segments if seg.get("text", "").strip())
@@ -609,30 +801,155 @@ def get_client():
     except: st.error("API key no configurada"); return None
 
 
+# ============================================================
+# CACHÉ DE TRANSCRIPCIONES (en disco, direccionada por contenido)
+# ============================================================
+CACHE_DIR = os.environ.get("TRANSCRIPTOR_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "transcriptor")
+CACHE_MAX_MB = int(os.environ.get("TRANSCRIPTOR_CACHE_MB", "500"))
+
+def cache_key(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def _cache_path(key): return os.path.join(CACHE_DIR, key[:2], f"{key}.json")
+
+def cache_get(key):
+    p = _cache_path(key)
+    try:
+        with open(p, "r", encoding="utf-8") as fp: value = json.load(fp)
+        os.utime(p)  # el mtime hace de marca de último uso para el LRU
+        return value
+    except: return None
+
+class CacheUsage:
+    """Tamaño total de la caché en disco, compartido entre reruns e hilos: se mide recorriendo el
+    directorio la primera vez (o al desalojar) y después se lleva la cuenta en cada escritura."""
+    def __init__(self):
+        self.lock, self.total = threading.Lock(), None
+
+@st.cache_resource
+def cache_usage(): return CacheUsage()
+
+_cache_usage = cache_usage()
+
+def cache_put(key, value):
+    p = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        tmp = f"{p}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp: json.dump(value, fp, ensure_ascii=False)
+        try: old = os.path.getsize(p)
+        except OSError: old = 0
+        new = os.path.getsize(tmp)
+        os.replace(tmp, p)
+        with _cache_usage.lock:
+            if _cache_usage.total is not None: _cache_usage.total += new - old
+            over = _cache_usage.total is None or _cache_usage.total > CACHE_MAX_MB * 1024 * 1024
+        if over: cache_evict()
+    except: pass
+
+def cache_evict(max_mb=None):
+    """Borra las entradas usadas hace más tiempo hasta quedar por debajo del límite de tamaño
+    (baja al 90 % para no volver a recorrer el directorio en la escritura siguiente)."""
+    limit = (max_mb or CACHE_MAX_MB) * 1024 * 1024
+    with _cache_usage.lock:
+        entries, total = [], 0
+        for root, _, files in os.walk(CACHE_DIR):
+            for fn in files:
+                if not fn.endswith(".json"): continue
+                fp = os.path.join(root, fn)
+                try: stt = os.stat(fp)
+                except OSError: continue
+                entries.append((stt.st_mtime, stt.st_size, fp)); total += stt.st_size
+        if total > limit:
+            for _, size, fp in sorted(entries):
+                try: os.remove(fp); total -= size
+                except OSError: pass
+                if total <= limit * 0.9: break
+        _cache_usage.total = total
+
+def audio_fingerprint(path, noise_db=-35, min_silence=0.4):
+    """Hash del audio decodificado (PCM 16 kHz mono), así una copia re-empaquetada da la misma
+    clave. En la misma pasada de ffmpeg se recogen los silencios para planificar los cortes.
+    Devuelve (hash, silencios); sin ffmpeg se usa el hash de los bytes del archivo."""
+    h = hashlib.sha256()
+    ffmpeg_bin = find_ffmpeg()
+    if ffmpeg_bin:
+        cmd = [ffmpeg_bin, "-hide_banner", "-nostats", "-i", path, "-vn",
+               "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}",
+               "-ac", "1", "-ar", "16000", "-f", "s16le", "-"]
+        try:
+            with tempfile.TemporaryFile() as log:
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+                for block in iter(lambda: proc.stdout.read(1 << 16), b""): h.update(block)
+                if proc.wait() == 0:
+                    log.seek(0)
+                    return "pcm:" + h.hexdigest(), _parse_silences(log.read().decode(errors="ignore"))
+        except: pass
+        h = hashlib.sha256()
+    try:
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""): h.update(block)
+        return "raw:" + h.hexdigest(), None
+    except: return None, None
+
+
 # ============================================================
 # AUDIO PROCESSING
 # ============================================================
-def save_uploaded(f):
+def save_uploaded(f, prefix="up_", directory=None):
     try:
         safe = "".join(c for c in f.name if c.isalnum() or c in "._-") or "audio.mp3"
-        path = os.path.join(tempfile.gettempdir(), f"up_{safe}")
+        if directory: os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory or tempfile.gettempdir(), f"{prefix}{safe}")
         with open(path, "wb") as fp: fp.write(f.getbuffer())
         return path
     except: return None
 
+def find_ffmpeg(name="ffmpeg"):
+    bin_path = shutil.which(name)
+    if not bin_path:
+        for c in [f"/usr/bin/{name}", f"/usr/local/bin/{name}"]:
+            if os.path.isfile(c): bin_path = c; break
+    return bin_path
+
+# Todo lo que se envía a Whisper va en mono 16 kHz con uno de estos perfiles de códec.
+# kbps es el peor caso, para validar contra el límite de 25 MB por petición (FLAC: PCM sin comprimir).
+# compression_level 7 = algoritmo rápido de LAME; para voz y ASR no cambia nada audible.
+WHISPER_AF = "aresample=16000,volume=1.5"
+UPLOAD_LIMIT_MB = 25
+UPLOAD_MAX_MS = 600_000      # parte o ventana de hueco más larga que se sube
+UPLOAD_PROFILES = {
+    "mp3":  {"ext": ".mp3",  "kbps": 64,  "label": "MP3 64 kbps",
+             "enc": ["-acodec", "libmp3lame", "-b:a", "64k", "-compression_level", "7"]},
+    "opus": {"ext": ".ogg",  "kbps": 24,  "label": "Opus 24 kbps (menos subida)",
+             "enc": ["-acodec", "libopus", "-b:a", "24k", "-vbr", "constrained", "-application", "voip"]},
+    "flac": {"ext": ".flac", "kbps": 256, "label": "FLAC (sin pérdida)",
+             "enc": ["-acodec", "flac"]},
+}
+
+def upload_args(codec):
+    return ["-ac", "1", "-ar", "16000", *UPLOAD_PROFILES[codec]["enc"]]
+
+def check_upload_profile(codec, max_ms=UPLOAD_MAX_MS):
+    """None si una subida de max_ms con este perfil cabe en el límite de Groq; si no, el motivo."""
+    prof = UPLOAD_PROFILES.get(codec)
+    if not prof: return f"Códec desconocido: {codec} (opciones: {', '.join(UPLOAD_PROFILES)})"
+    mb = prof["kbps"] * 1000 / 8 * max_ms / 1000 / (1024 * 1024)
+    if mb > UPLOAD_LIMIT_MB * 0.95:
+        return f"{codec}: hasta {mb:.0f} MB por parte de {fmt_duration(max_ms / 1000)}, supera {UPLOAD_LIMIT_MB} MB"
+    return None
+
+UPLOAD_CODEC = os.environ.get("TRANSCRIPTOR_UPLOAD_CODEC", "mp3")
+if check_upload_profile(UPLOAD_CODEC): UPLOAD_CODEC = "mp3"
+
 def convert_to_mp3(input_path, status_writer=None):
-    import shutil
     ext = os.path.splitext(input_path)[1].lower()
     size_mb = os.path.getsize(input_path) / (1024 * 1024)
     if ext == ".mp3" and size_mb < 24: return input_path, False
-    ffmpeg_bin = shutil.which("ffmpeg")
-    if not ffmpeg_bin:
-        for c in ["/usr/bin/ffmpeg", "/usr/local/bin/ffmpeg"]:
-            if os.path.isfile(c): ffmpeg_bin = c; break
+    ffmpeg_bin = find_ffmpeg()
     if not ffmpeg_bin: return input_path, False
     out_path = input_path.rsplit(".", 1)[0] + "_converted.mp3"
     if status_writer: status_writer.write(f"🔄 Convirtiendo a MP3 ({size_mb:.0f} MB)...")
-    import subprocess
     cmd = [ffmpeg_bin, "-y", "-i", input_path, "-vn", "-acodec", "libmp3lame",
            "-ac", "1", "-ar", "16000", "-b:a", "64k", "-af", "aresample=16000,volume=1.5", out_path]
     try:
@@ -645,51 +962,179 @@ def convert_to_mp3(input_path, status_writer=None):
     except: return input_path, False
 
 def get_audio_info(path):
-    ok, _ = check_pydub_ffmpeg()
-    if not ok: return None, None
+    """Duración en ms leída de la cabecera con ffprobe (sin decodificar el audio).
+    Si no hay ffprobe se usa la línea "Duration:" que imprime ffmpeg -i."""
+    ffprobe_bin = find_ffmpeg("ffprobe")
     try:
-        from pydub import AudioSegment
-        audio = AudioSegment.from_file(path); return len(audio), audio
-    except Exception as e: st.warning(f"⚠️ {e}"); return None, None
-
-def split_audio_chunks(audio_segment, chunk_duration_ms=600_000, overlap_ms=30_000):
-    total_ms = len(audio_segment); chunks = []
-    if total_ms <= chunk_duration_ms:
-        p = os.path.join(tempfile.gettempdir(), "chunk_0.mp3")
-        audio_segment.export(p, format="mp3", bitrate="128k")
-        return [{"path": p, "start_ms": 0, "end_ms": total_ms, "index": 0}]
-    start, idx = 0, 0
+        if ffprobe_bin:
+            r = subprocess.run([ffprobe_bin, "-v", "error", "-show_entries", "format=duration",
+                                "-of", "default=noprint_wrappers=1:nokey=1", path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+            out = r.stdout.decode(errors="ignore").strip()
+            if r.returncode == 0 and out and out != "N/A": return int(float(out) * 1000)
+        ffmpeg_bin = find_ffmpeg()
+        if not ffmpeg_bin: return None
+        r = subprocess.run([ffmpeg_bin, "-hide_banner", "-i", path],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+        m = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", r.stderr.decode(errors="ignore"))
+        if not m: return None
+        return int((int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))) * 1000)
+    except: return None
+
+def cut_audio(src, start_ms, end_ms, out_path, gain_db=0, codec=UPLOAD_CODEC):
+    """Corta [start_ms, end_ms) de src con un seek de ffmpeg, ya en el formato de Whisper;
+    la memoria no depende de la duración."""
+    ffmpeg_bin = find_ffmpeg()
+    if not ffmpeg_bin: return None
+    af = WHISPER_AF + (f",volume={gain_db}dB" if gain_db else "")
+    cmd = [ffmpeg_bin, "-y", "-v", "error", "-ss", f"{start_ms/1000:.3f}", "-t", f"{(end_ms-start_ms)/1000:.3f}",
+           "-i", src, "-vn", "-af", af, *upload_args(codec)]
+    try:
+        r = subprocess.run(cmd + [out_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=300)
+        return out_path if r.returncode == 0 and os.path.isfile(out_path) else None
+    except: return None
+
+def detect_silences(path, noise_db=-35, min_silence=0.4):
+    """Silencios [(inicio_s, fin_s)] según el filtro silencedetect de ffmpeg (una pasada en streaming)."""
+    ffmpeg_bin = find_ffmpeg()
+    if not ffmpeg_bin: return []
+    cmd = [ffmpeg_bin, "-hide_banner", "-nostats", "-i", path, "-vn",
+           "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"]
+    try: r = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=600)
+    except: return []
+    return _parse_silences(r.stderr.decode(errors="ignore"))
+
+def _parse_silences(log):
+    silences, start = [], None
+    for line in log.splitlines():
+        m = re.search(r"silence_start: (-?[\d.]+)", line)
+        if m: start = max(0.0, float(m.group(1))); continue
+        m = re.search(r"silence_end: ([\d.]+)", line)
+        if m and start is not None: silences.append((start, float(m.group(1)))); start = None
+    return silences
+
+def plan_chunk_boundaries(total_ms, silences, chunk_duration_ms=600_000, overlap_ms=30_000,
+                          search_ms=60_000, silence_overlap_ms=500):
+    """Planifica los cortes: cada parte termina en el silencio más largo de los últimos
+    search_ms antes del límite, y la siguiente arranca casi sin overlap. Si no hay
+    silencio cerca se vuelve al corte fijo con overlap_ms."""
+    plan, start = [], 0
     while start < total_ms:
-        end = min(start + chunk_duration_ms, total_ms)
-        chunk = audio_segment[start:end]
-        p = os.path.join(tempfile.gettempdir(), f"chunk_{idx}.mp3")
-        chunk.export(p, format="mp3", bitrate="128k")
-        if os.path.getsize(p) / (1024*1024) > 24: chunk.export(p, format="mp3", bitrate="64k")
-        chunks.append({"path": p, "start_ms": start, "end_ms": end, "index": idx})
-        if end >= total_ms: break
-        start = end - overlap_ms; idx += 1
+        limit = start + chunk_duration_ms
+        if limit >= total_ms:
+            plan.append({"start_ms": start, "end_ms": total_ms, "overlap_ms": plan[-1]["next_overlap_ms"] if plan else 0}); break
+        lo = max(start + chunk_duration_ms // 2, limit - search_ms)
+        cands = [(e - s, (s + e) / 2 * 1000) for s, e in silences if lo <= (s + e) / 2 * 1000 <= limit]
+        prev_ov = plan[-1]["next_overlap_ms"] if plan else 0
+        if cands:
+            cut = int(max(cands)[1])
+            plan.append({"start_ms": start, "end_ms": cut, "overlap_ms": prev_ov, "next_overlap_ms": silence_overlap_ms})
+            start = cut - silence_overlap_ms
+        else:
+            plan.append({"start_ms": start, "end_ms": limit, "overlap_ms": prev_ov, "next_overlap_ms": overlap_ms})
+            start = limit - overlap_ms
+    return plan
+
+def segment_audio(src, plan, workdir, codec=UPLOAD_CODEC):
+    """Una sola invocación de ffmpeg: decodifica src una vez, remuestrea/normaliza una vez y
+    escribe todas las partes del plan (con sus overlaps) ya codificadas para Whisper.
+    Devuelve las rutas en el orden del plan, o None si ffmpeg falla."""
+    ffmpeg_bin = find_ffmpeg()
+    if not ffmpeg_bin or not plan: return None
+    n = len(plan); ext = UPLOAD_PROFILES[codec]["ext"]
+    paths = [os.path.join(workdir, f"chunk_{i}{ext}") for i in range(n)]
+    graph = [f"[0:a]{WHISPER_AF},asplit={n}" + "".join(f"[s{i}]" for i in range(n))]
+    graph += [f"[s{i}]atrim=start={pl['start_ms']/1000:.3f}:end={pl['end_ms']/1000:.3f},asetpts=PTS-STARTPTS[c{i}]"
+              for i, pl in enumerate(plan)]
+    cmd = [ffmpeg_bin, "-y", "-v", "error", "-i", src, "-vn", "-filter_complex", ";".join(graph)]
+    for i, p in enumerate(paths): cmd += ["-map", f"[c{i}]", *upload_args(codec), p]
+    try:
+        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=max(600, n * 120))
+        if r.returncode == 0 and all(os.path.isfile(p) and os.path.getsize(p) > 0 for p in paths): return paths
+    except: pass
+    return None
+
+def split_audio_chunks(path, total_ms, chunk_duration_ms=600_000, overlap_ms=30_000, workdir=None, silences=None,
+                       codec=UPLOAD_CODEC):
+    workdir = workdir or tempfile.gettempdir(); chunks = []
+    if silences is None and total_ms > chunk_duration_ms: silences = detect_silences(path)
+    plan = plan_chunk_boundaries(total_ms, silences or [], chunk_duration_ms, overlap_ms)
+    paths = segment_audio(path, plan, workdir, codec)
+    ext = UPLOAD_PROFILES[codec]["ext"]
+    for idx, pl in enumerate(plan):
+        start, end = pl["start_ms"], pl["end_ms"]
+        # Si la pasada única falla (p. ej. un contenedor raro) se corta parte por parte
+        p = paths[idx] if paths else cut_audio(path, start, end, os.path.join(workdir, f"chunk_{idx}{ext}"), codec=codec)
+        if p and os.path.getsize(p) > UPLOAD_LIMIT_MB * 0.95 * 1024 * 1024:
+            os.remove(p); p = cut_audio(path, start, end, os.path.join(workdir, f"chunk_{idx}.ogg"), codec="opus")
+        if p: chunks.append({"path": p, "start_ms": start, "end_ms": end, "index": idx, "overlap_ms": pl["overlap_ms"]})
     return chunks
 
+def parse_vocab(custom_vocab):
+    """Términos del vocabulario personalizado (uno por línea o separados por comas)."""
+    if not custom_vocab or not custom_vocab.strip(): return []
+    return [t.strip() for line in custom_vocab.replace(",", "\n").split("\n") for t in [line.strip()] if t and len(t) > 1]
+
 def build_prompt_vocabulary(custom_vocab):
-    if not custom_vocab or not custom_vocab.strip(): return None
-    terms = [t.strip() for line in custom_vocab.replace(",", "\n").split("\n") for t in [line.strip()] if t and len(t) > 1]
+    terms = parse_vocab(custom_vocab)
     return ". ".join(terms) + "." if terms else None
 
-def transcribe_single(client, path, model, prompt=None, max_retries=3):
+def _field(obj, name, default=None):
+    return obj.get(name, default) if isinstance(obj, dict) else getattr(obj, name, default)
+
+def attach_words(segments, words):
+    """Reparte las palabras de Whisper entre los segmentos (por el punto medio de cada palabra).
+    Forma compacta por segmento: "words": [[inicio_s, fin_s, "palabra"], ...]."""
+    if not words: return segments
+    wi = 0
+    for i, seg in enumerate(segments):
+        nxt = segments[i+1]["start"] if i + 1 < len(segments) else float("inf")
+        out = []
+        while wi < len(words) and (words[wi][0] + words[wi][1]) / 2 < nxt:
+            out.append(words[wi]); wi += 1
+        if out: seg["words"] = out
+    return segments
+
+def shift_words(words, offset):
+    return [[round(ws + offset, 2), round(we + offset, 2), w] for ws, we, w in words]
+
+def word_time(seg, k):
+    """Inicio de la palabra k del texto del segmento; sin marcas de palabra, el inicio del segmento."""
+    words = seg.get("words")
+    if not words: return float(seg.get("start", 0))
+    n = max(1, len(seg.get("text", "").split()))
+    return float(words[min(len(words) - 1, round(k * len(words) / n))][0])
+
+WHISPER_SIGNALS = ("no_speech_prob", "avg_logprob", "compression_ratio")
+
+def transcribe_single(client, path, model, prompt=None, max_retries=3, cache_id=None):
+    key = cache_key("whisper-words", cache_id, model, prompt) if cache_id else None
+    if key:
+        hit = cache_get(key)
+        if hit: return hit["text"], hit["segments"], None
     for attempt in range(max_retries):
         try:
             with open(path, "rb") as f: file_data = f.read()
             kwargs = {"file": (os.path.basename(path), file_data), "model": model,
-                      "response_format": "verbose_json", "language": "es", "temperature": 0.0}
+                      "response_format": "verbose_json", "timestamp_granularities": ["word", "segment"],
+                      "language": "es", "temperature": 0.0}
             if prompt: kwargs["prompt"] = prompt
             t = client.audio.transcriptions.create(**kwargs)
             segments = []
             if t.segments:
                 for seg in t.segments:
-                    if isinstance(seg, dict): s, e, tx = seg.get("start", 0), seg.get("end", 0), seg.get("text", "")
-                    else: s, e, tx = getattr(seg, "start", 0), getattr(seg, "end", 0), getattr(seg, "text", "")
+                    s, e, tx = _field(seg, "start", 0), _field(seg, "end", 0), _field(seg, "text", "")
                     text = str(tx).strip()
-                    if text: segments.append({"start": float(s), "end": float(e), "text": text})
+                    if not text: continue
+                    out = {"start": float(s), "end": float(e), "text": text}
+                    for f in WHISPER_SIGNALS:
+                        v = _field(seg, f)
+                        if v is not None: out[f] = round(float(v), 3)
+                    segments.append(out)
+            words = [[round(float(_field(w, "start", 0)), 2), round(float(_field(w, "end", 0)), 2), str(_field(w, "word", "")).strip()]
+                     for w in (_field(t, "words") or [])]
+            attach_words(segments, [w for w in words if w[2]])
+            if key and segments: cache_put(key, {"text": t.text or "", "segments": segments})
             return t.text or "", segments, None
         except Exception as e:
             err_str = str(e)
@@ -698,302 +1143,965 @@ def transcribe_single(client, path, model, prompt=None, max_retries=3):
             else: return None, None, err_str
     return None, None, "Max retries"
 
+DEDUP_BUCKET_S = 5.0
+
+def _dedup_key(seg):
+    n = seg_norm(seg); return n, frozenset(n.split())
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+class SegmentTimeIndex:
+    """Índice de segmentos por cubetas de tiempo. El texto normalizado y su conjunto de
+    palabras se calculan una sola vez por segmento y solo se comparan vecinos en el tiempo,
+    así deduplicar cuesta O(n) aunque el audio dure horas."""
+    def __init__(self, bucket_s=DEDUP_BUCKET_S):
+        self.bucket_s = bucket_s; self.buckets = {}; self.max_dur = 0.0
+
+    def add(self, seg, key=None):
+        n, toks = key or _dedup_key(seg)
+        self.buckets.setdefault(int(seg["start"] // self.bucket_s), []).append((seg["start"], seg["end"], n, toks))
+        self.max_dur = max(self.max_dur, seg["end"] - seg["start"])
+
+    def near(self, start, end, tol):
+        lo, hi = int((start - self.max_dur - tol) // self.bucket_s), int((end + tol) // self.bucket_s)
+        for b in range(lo, hi + 1):
+            for e in self.buckets.get(b, ()):
+                if e[1] >= start - tol and e[0] <= end + tol: yield e
+
+    def is_duplicate(self, seg, key=None, tol=2.0, min_jac=0.5, near_start_jac=0.35):
+        n, toks = key or _dedup_key(seg)
+        for s, _, en, etoks in self.near(seg["start"], seg["end"], tol):
+            j = jaccard(toks, etoks)
+            if (j > min_jac or (len(n) > 5 and (n in en or en in n))
+                    or (abs(seg["start"] - s) < tol and j > near_start_jac)): return True
+        return False
+
 def merge_chunk_segments(all_chunk_results, overlap_ms=30_000):
     if not all_chunk_results: return [], ""
-    if len(all_chunk_results) == 1: return all_chunk_results[0]["segments"], all_chunk_results[0]["text"]
-    merged = []
+    if len(all_chunk_results) == 1 and not all_chunk_results[0]["start_ms"]:
+        return all_chunk_results[0]["segments"], all_chunk_results[0]["text"]
+    merged, idx = [], SegmentTimeIndex()
     for ci, cr in enumerate(all_chunk_results):
         offset = cr["start_ms"] / 1000.0
-        adjusted = [{"start": s["start"]+offset, "end": s["end"]+offset, "text": s["text"]} for s in cr["segments"]]
-        if ci == 0: merged.extend(adjusted); continue
-        if not merged: merged.extend(adjusted); continue
-        oe = (cr["start_ms"]/1000.0) + (overlap_ms/1000.0)
-        for seg in adjusted:
-            if seg["end"] <= oe:
-                sn = norm(seg["text"])
-                if any(SequenceMatcher(None, sn, norm(e["text"])).ratio() > 0.65 or
-                       (len(sn) > 5 and (sn in norm(e["text"]) or norm(e["text"]) in sn)) or
-                       (abs(seg["start"]-e["start"]) < 2.0 and SequenceMatcher(None, sn, norm(e["text"])).ratio() > 0.5)
-                       for e in merged[-15:]): continue
-            merged.append(seg)
+        oe = offset + (cr.get("overlap_ms", overlap_ms)/1000.0)
+        for s in cr["segments"]:
+            seg = {**s, "start": s["start"]+offset, "end": s["end"]+offset}
+            if s.get("words"): seg["words"] = shift_words(s["words"], offset)
+            key = _dedup_key(seg)
+            # Solo lo que cae en el overlap con la parte anterior puede estar repetido
+            if ci and seg["end"] <= oe and idx.is_duplicate(seg, key): continue
+            idx.add(seg, key); merged.append(seg)
     merged.sort(key=lambda x: x["start"])
     return merged, " ".join(s["text"] for s in merged)
 
+class CoverageIndex:
+    """Unión de los intervalos cubiertos, ordenada y sin solapes (dos listas paralelas).
+    Insertar un segmento cuesta O(log n) más los intervalos que fusiona, y los huecos se
+    consultan solo dentro del rango pedido: tras una pasada de recuperación basta mirar
+    dentro de los huecos anteriores, porque la cobertura solo crece."""
+    def __init__(self, segments=()):
+        self.starts, self.ends, self.covered = [], [], 0.0
+        for s, e in sorted((seg["start"], seg["end"]) for seg in segments):
+            if e <= s: continue
+            if self.ends and s <= self.ends[-1]:
+                if e > self.ends[-1]: self.covered += e - self.ends[-1]; self.ends[-1] = e
+            else: self.starts.append(s); self.ends.append(e); self.covered += e - s
+
+    def add(self, start, end):
+        if end <= start: return
+        i = bisect.bisect_left(self.ends, start); j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start, end = min(start, self.starts[i]), max(end, self.ends[j-1])
+            self.covered -= sum(self.ends[k] - self.starts[k] for k in range(i, j))
+        self.starts[i:j] = [start]; self.ends[i:j] = [end]; self.covered += end - start
+
+    def covers(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        return i >= 0 and self.ends[i] >= t
+
+    def coverage_pct(self, total_sec):
+        return min(100.0, self.covered / total_sec * 100) if total_sec > 0 else 0.0
+
+    def gaps(self, lo, hi, threshold=5.0):
+        out, t = [], lo
+        i = bisect.bisect_right(self.ends, lo)
+        while i < len(self.starts) and self.starts[i] < hi:
+            if self.starts[i] - t > threshold: out.append({"start": t, "end": self.starts[i], "duration": self.starts[i] - t})
+            t = max(t, self.ends[i]); i += 1
+        if hi - t > threshold: out.append({"start": t, "end": hi, "duration": hi - t})
+        return out
+
 def find_coverage_gaps(segments, total_sec, threshold=5.0):
-    if not segments: return [{"start": 0, "end": total_sec, "duration": total_sec}]
-    gaps = []; ss = sorted(segments, key=lambda x: x["start"])
-    if ss[0]["start"] > threshold: gaps.append({"start": 0, "end": ss[0]["start"], "duration": ss[0]["start"]})
-    for i in range(len(ss)-1):
-        g = ss[i+1]["start"] - ss[i]["end"]
-        if g > threshold: gaps.append({"start": ss[i]["end"], "end": ss[i+1]["start"], "duration": g})
-    if ss and total_sec - ss[-1]["end"] > threshold:
-        gaps.append({"start": ss[-1]["end"], "end": total_sec, "duration": total_sec - ss[-1]["end"]})
-    return gaps
+    return CoverageIndex(segments).gaps(0, total_sec, threshold)
 
 def calculate_coverage(segments, total_sec):
-    if not segments or total_sec <= 0: return 0.0
-    intervals = sorted([(s["start"], s["end"]) for s in segments])
-    merged = [list(intervals[0])]
-    for s, e in intervals[1:]:
-        if s <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], e)
-        else: merged.append([s, e])
-    return min(100.0, (sum(e-s for s, e in merged) / total_sec) * 100)
-
-def retranscribe_gaps(client, audio_seg, gaps, model, prompt=None, sw=None):
-    recovered = []
-    for gi, gap in enumerate(gaps):
-        if sw: sw.write(f"🔄 Hueco {gi+1}/{len(gaps)}: {fmt_time(gap['start'])} → {fmt_time(gap['end'])}")
-        margin = 5000
-        s_ms = max(0, int(gap["start"]*1000)-margin)
-        e_ms = min(len(audio_seg), int(gap["end"]*1000)+margin)
-        ga = audio_seg[s_ms:e_ms]
-        gp = os.path.join(tempfile.gettempdir(), f"gap_{gi}.mp3")
-        ga.export(gp, format="mp3", bitrate="128k")
-        _, best, _ = transcribe_single(client, gp, model, prompt=prompt, max_retries=3)
-        if not best:
-            try:
-                gal = ga + 6; gpl = os.path.join(tempfile.gettempdir(), f"gap_{gi}_l.mp3")
-                gal.export(gpl, format="mp3", bitrate="128k")
-                _, best, _ = transcribe_single(client, gpl, model, prompt=prompt, max_retries=2)
-                try: os.remove(gpl)
-                except: pass
+    if not segments: return 0.0
+    return CoverageIndex(segments).coverage_pct(total_sec)
+
+def insert_recovered(segments, starts, recovered, idx, cover, tol=1.5, min_jac=0.5):
+    """Inserta en su sitio (segments ordenados por inicio, starts paralela) los segmentos recuperados
+    que no repiten a un vecino; solo se tocan los recuperados, no la transcripción entera."""
+    added = 0
+    for seg in sorted(recovered, key=lambda x: x["start"]):
+        key = _dedup_key(seg)
+        if idx.is_duplicate(seg, key, tol=tol, min_jac=min_jac, near_start_jac=min_jac): continue
+        i = bisect.bisect_right(starts, seg["start"])
+        starts.insert(i, seg["start"]); segments.insert(i, seg); added += 1
+        if not seg.get("hallucination_suspect"): idx.add(seg, key); cover.add(seg["start"], seg["end"])
+    return added
+
+MAX_PARALLEL_CHUNKS = 4
+GAP_MARGIN_MS = 5000          # contexto a cada lado del hueco
+GAP_JOIN_MS = 15_000          # ventanas (ya con su margen) más cerca que esto comparten petición:
+                              # entre huecos son GAP_JOIN_MS + 2 × GAP_MARGIN_MS = 25 s
+GAP_WINDOW_MAX_MS = 180_000
+
+def coalesce_gaps(gaps, total_ms, margin_ms=GAP_MARGIN_MS, join_ms=GAP_JOIN_MS, max_ms=GAP_WINDOW_MAX_MS):
+    """Agrupa huecos cercanos en ventanas {start_ms, end_ms, gaps}; cada ventana es una sola petición."""
+    windows = []
+    for g in sorted(gaps, key=lambda g: g["start"]):
+        s_ms = max(0, int(g["start"]*1000) - margin_ms); e_ms = min(total_ms, int(g["end"]*1000) + margin_ms)
+        w = windows[-1] if windows else None
+        if w and s_ms - w["end_ms"] <= join_ms and max(e_ms, w["end_ms"]) - w["start_ms"] <= max_ms:
+            w["end_ms"] = max(w["end_ms"], e_ms); w["gaps"].append(g)
+        else: windows.append({"start_ms": s_ms, "end_ms": e_ms, "gaps": [g]})
+    # Un hueco enorme (p. ej. una parte entera que falló) se parte para no pasar del límite de subida
+    out = []
+    for w in windows:
+        for s_ms in range(w["start_ms"], w["end_ms"], UPLOAD_MAX_MS):
+            out.append({**w, "start_ms": s_ms, "end_ms": min(w["end_ms"], s_ms + UPLOAD_MAX_MS)})
+    return out
+
+def _retranscribe_window(client, path, w, wi, model, prompt, workdir, fingerprint, codec=UPLOAD_CODEC):
+    """Devuelve (segmentos recuperados, falló): falla si el último intento acabó en error y no en silencio."""
+    # Cada intento corta su trozo de la fuente justo antes de usarlo (seek de ffmpeg)
+    s_ms, e_ms = w["start_ms"], w["end_ms"]
+    cid = [fingerprint, s_ms, e_ms] if fingerprint else None
+    ext = UPLOAD_PROFILES[codec]["ext"]
+    gp = cut_audio(path, s_ms, e_ms, os.path.join(workdir, f"gap_{wi}{ext}"), codec=codec)
+    if not gp: return [], True
+    _, best, err = transcribe_single(client, gp, model, prompt=prompt, max_retries=3, cache_id=cid)
+    if not best:
+        gpl = cut_audio(path, s_ms, e_ms, os.path.join(workdir, f"gap_{wi}_l{ext}"), gain_db=6, codec=codec)
+        if gpl:
+            _, best, err = transcribe_single(client, gpl, model, prompt=prompt, max_retries=2,
+                                             cache_id=cid and cid + ["+6dB"])
+            try: os.remove(gpl)
             except: pass
-        if not best:
-            alt = "whisper-large-v3-turbo" if "turbo" not in model else "whisper-large-v3"
-            _, best, _ = transcribe_single(client, gp, alt, prompt=None, max_retries=2)
-        if best:
-            off = s_ms / 1000.0
-            for seg in best: seg["start"] += off; seg["end"] += off; seg["recovered"] = True
-            recovered.extend(best)
-        try: os.remove(gp)
-        except: pass
-    return recovered
-
-def transcribe_complete(client, path, model, prompt=None, ps=None):
+    if not best:
+        alt = "whisper-large-v3-turbo" if "turbo" not in model else "whisper-large-v3"
+        _, best, err = transcribe_single(client, gp, alt, prompt=None, max_retries=2, cache_id=cid)
+    try: os.remove(gp)
+    except: pass
+    off = s_ms / 1000.0; out = []
+    for seg in best or []:
+        seg = {**seg, "start": seg["start"] + off, "end": seg["end"] + off, "recovered": True}
+        if seg.get("words"): seg["words"] = shift_words(seg["words"], off)
+        # Una ventana que une varios huecos también cubre habla ya transcrita entre ellos
+        if len(w["gaps"]) == 1 or any(seg["end"] > g["start"] and seg["start"] < g["end"] for g in w["gaps"]):
+            out.append(seg)
+    return out, not best and err is not None
+
+def retranscribe_gaps(client, path, total_ms, gaps, model, prompt=None, sw=None, workdir=None, fingerprint=None,
+                      max_workers=MAX_PARALLEL_CHUNKS, codec=UPLOAD_CODEC):
+    workdir = workdir or tempfile.gettempdir()
+    """Devuelve (segmentos recuperados en orden, ventanas que fallaron)."""
+    windows = coalesce_gaps(gaps, total_ms)
+    if not windows: return [], 0
+    if sw: sw.write(f"🔄 {len(gaps)} hueco{'s' if len(gaps) > 1 else ''} → {len(windows)} "
+                    f"petici{'ones' if len(windows) > 1 else 'ón'}")
+    recovered, done, failed = [], 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers or 1, len(windows)))) as pool:
+        futures = {pool.submit(_retranscribe_window, client, path, w, wi, model, prompt, workdir, fingerprint, codec): w
+                   for wi, w in enumerate(windows)}
+        for fut in as_completed(futures):
+            done += 1; w = futures[fut]; segs, bad = fut.result()
+            recovered.extend(segs); failed += bad
+            if sw: sw.write(f"🔄 Ventana {done}/{len(windows)}: {fmt_time(w['start_ms']/1000)} → {fmt_time(w['end_ms']/1000)}")
+    recovered.sort(key=lambda x: x["start"])
+    return recovered, failed
+
+def _transcribe_chunk(client, ch, model, prompt=None):
+    text, segs, _ = transcribe_single(client, ch["path"], model, prompt=prompt, cache_id=ch.get("cache_id"))
+    if not segs:
+        alt = "whisper-large-v3-turbo" if "turbo" not in model else "whisper-large-v3"
+        text, segs, _ = transcribe_single(client, ch["path"], alt, prompt=prompt, cache_id=ch.get("cache_id"))
+    try: os.remove(ch["path"])
+    except: pass
+    if not segs: return None
+    return {"text": text, "segments": segs, "start_ms": ch["start_ms"], "end_ms": ch["end_ms"],
+            "index": ch["index"], "overlap_ms": ch["overlap_ms"]}
+
+def transcribe_complete(client, path, model, prompt=None, ps=None, max_workers=MAX_PARALLEL_CHUNKS,
+                        fingerprint=None, silences=None, codec=UPLOAD_CODEC, on_partial=None):
+    """Devuelve (texto, segmentos, duración ms, cobertura, huecos, partes, fallos); fallos cuenta las partes
+    sin texto y las ventanas de recuperación que acabaron en error: ese resultado no se guarda en caché."""
     if ps: ps.write("📏 Analizando audio...")
-    dur_ms, audio_seg = get_audio_info(path)
-    if dur_ms is None or audio_seg is None:
+    dur_ms = get_audio_info(path)
+    if not dur_ms:
         if ps: ps.write("ℹ️ Modo directo")
-        text, segs, err = transcribe_single(client, path, model, prompt=prompt)
-        if err or not segs: return None, None, 0, 0, [], 1
+        converted_path, was_converted = convert_to_mp3(path, status_writer=ps)
+        text, segs, err = transcribe_single(client, converted_path, model, prompt=prompt, cache_id=fingerprint and [fingerprint])
+        if was_converted and converted_path != path:
+            try: os.remove(converted_path)
+            except: pass
+        if err or not segs: return None, None, 0, 0, [], 1, 1
         ds = max(s["end"] for s in segs) if segs else 0
-        return text, segs, int(ds*1000), calculate_coverage(segs, ds), [], 1
+        return text, segs, int(ds*1000), calculate_coverage(segs, ds), [], 1, 0
     ds = dur_ms / 1000.0
     if ps: ps.write(f"⏱️ {fmt_duration(ds)}")
-    chunks = split_audio_chunks(audio_seg, overlap_ms=30_000)
-    nc = len(chunks)
-    if ps: ps.write(f"✂️ {nc} parte{'s' if nc > 1 else ''}")
-    all_res = []
-    for ci, ch in enumerate(chunks):
-        if ps: ps.write(f"🎧 Parte {ci+1}/{nc}...")
-        text, segs, err = transcribe_single(client, ch["path"], model, prompt=prompt)
-        if segs: all_res.append({"text": text, "segments": segs, "start_ms": ch["start_ms"], "end_ms": ch["end_ms"]})
-        elif ps:
-            alt = "whisper-large-v3-turbo" if "turbo" not in model else "whisper-large-v3"
-            t2, s2, _ = transcribe_single(client, ch["path"], alt, prompt=prompt)
-            if s2: all_res.append({"text": t2, "segments": s2, "start_ms": ch["start_ms"], "end_ms": ch["end_ms"]})
-        try: os.remove(ch["path"])
-        except: pass
-    if not all_res: return None, None, dur_ms, 0, [], nc
+    workdir = tempfile.mkdtemp(prefix="tcr_")
+    try:
+        return _transcribe_chunks(client, path, dur_ms, model, prompt, ps, max_workers, workdir, fingerprint, silences, codec,
+                                  on_partial)
+    finally: shutil.rmtree(workdir, ignore_errors=True)
+
+def _transcribe_chunks(client, path, dur_ms, model, prompt, ps, max_workers, workdir, fingerprint=None, silences=None,
+                       codec=UPLOAD_CODEC, on_partial=None):
+    ds = dur_ms / 1000.0
+    chunks = split_audio_chunks(path, dur_ms, overlap_ms=30_000, workdir=workdir, silences=silences, codec=codec)
+    if not chunks: return None, None, dur_ms, 0, [], 0, 1
+    up_bytes = sum(os.path.getsize(ch["path"]) for ch in chunks)
+    up_min = sum(ch["end_ms"] - ch["start_ms"] for ch in chunks) / 60_000
+    if ps: ps.write(f"📦 {codec}: {up_bytes / 1024 / max(up_min, 1e-6):.0f} KB por minuto de audio · "
+                    f"{up_bytes / (1024*1024):.1f} MB a subir")
+    for ch in chunks: ch["cache_id"] = [fingerprint, ch["start_ms"], ch["end_ms"]] if fingerprint else None
+    nc = len(chunks); workers = max(1, min(max_workers or 1, nc))
+    soft = sum(1 for ch in chunks[1:] if ch["overlap_ms"] < 30_000)
+    if ps: ps.write(f"✂️ {nc} parte{'s' if nc > 1 else ''} · {workers} en paralelo"
+                    + (f" · {soft} corte{'s' if soft > 1 else ''} en silencio" if soft else ""))
+    # Las partes se transcriben en paralelo; el progreso se escribe desde este hilo
+    # porque los hilos del pool no tienen contexto de Streamlit.
+    all_res, done = [], 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_transcribe_chunk, client, ch, model, prompt) for ch in chunks]
+        for fut in as_completed(futures):
+            done += 1; res = fut.result()
+            if res: all_res.append(res)
+            if ps: ps.write(f"🎧 Parte {done}/{nc} lista")
+            # Vista previa: lo que ya hay, fusionado en orden (las partes pueden acabar desordenadas)
+            if on_partial and res and done < nc:
+                on_partial(list(merge_chunk_segments(sorted(all_res, key=lambda r: r["index"]), overlap_ms=30_000)[0]),
+                           "transcripción")
+    all_res.sort(key=lambda r: r["index"])
+    if not all_res: return None, None, dur_ms, 0, [], nc, nc
+    failed = nc - len(all_res)  # una parte sin texto tras el modelo alternativo (error o silencio entero)
     merged, ft = merge_chunk_segments(all_res, overlap_ms=30_000)
     
     # [INTEGRACIÓN MEJORA 2] Filtrar alucinaciones antes de calcular cobertura
     merged = filter_hallucinations(merged)
     ft = " ".join(s["text"] for s in merged if not s.get("hallucination_suspect"))
 
-    cov = calculate_coverage(merged, ds); gaps = find_coverage_gaps(merged, ds)
+    # Los segmentos dudosos no cubren: su tramo queda como hueco y la recuperación lo reintenta
+    cover = CoverageIndex(s for s in merged if not s.get("hallucination_suspect"))
+    cov = cover.coverage_pct(ds); gaps = cover.gaps(0, ds)
+    n_susp = sum(1 for s in merged if s.get("hallucination_suspect"))
+    if ps and n_susp: ps.write(f"⚠️ {n_susp} segmento{'s' if n_susp > 1 else ''} dudoso{'s' if n_susp > 1 else ''} → se reintentan")
+    starts = idx = None
     for pn in range(3):
         if cov >= 99.5: break
         th = [3.0, 2.0, 1.5][min(pn, 2)]
         sg = [g for g in gaps if g["duration"] >= th]
         if not sg: break
-        rec = retranscribe_gaps(client, audio_seg, sg, model, prompt=prompt, sw=ps)
-        if rec:
-            merged.extend(rec); merged.sort(key=lambda x: x["start"])
-            dd = []
-            for seg in merged:
-                if not any(abs(seg["start"]-e["start"]) < 1.5 and SequenceMatcher(None, norm(seg["text"]), norm(e["text"])).ratio() > 0.6 for e in dd[-10:]):
-                    dd.append(seg)
-            merged = dd; ft = " ".join(s["text"] for s in merged)
-            cov = calculate_coverage(merged, ds); gaps = find_coverage_gaps(merged, ds, gap_threshold=th)
-        else: break
+        rec, bad = retranscribe_gaps(client, path, dur_ms, sg, model, prompt=prompt, sw=ps, workdir=workdir,
+                                     fingerprint=fingerprint, max_workers=max_workers, codec=codec)
+        failed += bad
+        if not rec: break
+        if idx is None:
+            # El índice de vecinos de la transcripción se construye una vez, solo si hay que recuperar
+            starts, idx = [s["start"] for s in merged], SegmentTimeIndex()
+            for s in merged:
+                if not s.get("hallucination_suspect"): idx.add(s)
+        insert_recovered(merged, starts, filter_hallucinations(rec), idx, cover)
+        cov = cover.coverage_pct(ds)
+        # La cobertura solo crece: los huecos nuevos están dentro de los que se intentaron
+        gaps = [ng for g in sg for ng in cover.gaps(g["start"], g["end"], threshold=th)]
+    if idx is not None:
+        # Un segmento dudoso cuyo tramo ya tiene texto recuperado sobra
+        merged = [s for s in merged if not (s.get("hallucination_suspect") and cover.covers((s["start"] + s["end"]) / 2))]
+        ft = segments_text(merged)
+    if on_partial: on_partial(list(merged), "transcripción")
     if ps: ps.write(f"✅ Cobertura: {cov:.1f}%")
-    return ft, merged, dur_ms, cov, gaps, nc
+    return ft, merged, dur_ms, cov, gaps, nc, failed
+
+
+# ============================================================
+# IA: LLAMADAS EN PARALELO
+# ============================================================
+# Las llamadas a Groq son I/O puro: el cliente es seguro entre hilos, así que las tareas
+# independientes (bloques de corrección, análisis de un texto terminado) se lanzan juntas.
+# Las funciones que corren en el pool no tocan st.session_state; el hilo que llama guarda.
+# Un limitador por proceso reparte las peticiones y los tokens por minuto entre todos los hilos;
+# un 429 pausa a todos y la petición se reintenta con espera antes de rendirse.
+LLM_WORKERS = int(os.environ.get("TRANSCRIPTOR_LLM_WORKERS", "6"))
+LLM_RPM = int(os.environ.get("TRANSCRIPTOR_LLM_RPM", "30"))
+LLM_TPM = int(os.environ.get("TRANSCRIPTOR_LLM_TPM", "12000"))
+LLM_RETRIES = 4
+LLM_PROMPT_TOKENS = 400  # instrucciones y formato de la petición, aparte del texto
+
+class RateLimiter:
+    """Espacia las peticiones para no pasar de per_minute y reserva los tokens estimados de cada una
+    en una cubeta de tokens_per_minute que se rellena de forma continua; seguro entre hilos."""
+    def __init__(self, per_minute, tokens_per_minute=0):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.tpm = tokens_per_minute
+        self.lock = threading.Lock(); self.next_t = 0.0
+        self.level, self.level_t = float(tokens_per_minute), time.monotonic()
+
+    def wait(self, tokens=0):
+        with self.lock:
+            now = time.monotonic(); t = max(now, self.next_t)
+            if self.tpm > 0 and tokens:
+                # El nivel puede quedar en negativo: es la deuda que esperan las peticiones siguientes
+                tokens = min(tokens, self.tpm)
+                self.level = min(self.tpm, self.level + (now - self.level_t) * self.tpm / 60.0); self.level_t = now
+                if self.level < tokens: t = max(t, now + (tokens - self.level) * 60.0 / self.tpm)
+                self.level -= tokens
+            self.next_t = t + self.interval
+        if t > now: time.sleep(t - now)
+
+    def pause(self, seconds):
+        """Tras un 429 ninguna petición sale antes de seconds."""
+        with self.lock: self.next_t = max(self.next_t, time.monotonic() + seconds)
+
+@st.cache_resource
+def llm_executor():
+    return ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="tcr_llm")
+
+@st.cache_resource
+def llm_rate_limiter():
+    return RateLimiter(LLM_RPM, LLM_TPM)
+
+def _retry_after(err, attempt):
+    try: return float(err.response.headers["retry-after"])
+    except Exception: return min(60.0, 2.0 * 2 ** attempt)
+
+def _limited(limiter, fn, *args, tokens=0, **kwargs):
+    for attempt in range(LLM_RETRIES + 1):
+        limiter.wait(tokens)
+        try: return fn(*args, **kwargs)
+        except RateLimitError as e:
+            if attempt == LLM_RETRIES: raise
+            limiter.pause(_retry_after(e, attempt))
+
+def request_tokens(text, overhead=LLM_PROMPT_TOKENS):
+    """Tokens que consumirá una petición de corrección: texto de entrada, su max_tokens e instrucciones."""
+    return overhead + estimate_tokens(text) + output_tokens(text)
+
+def llm_chat(client, system, user, max_tokens, temperature=0.0, limiter=None):
+    """Una petición al chat bajo el limitador: reserva lo que se envía más max_tokens y reintenta los 429.
+    Devuelve el texto de la respuesta; si se agotan los reintentos sale RateLimitError."""
+    r = _limited(limiter or llm_rate_limiter(), client.chat.completions.create,
+                 tokens=estimate_tokens(system) + estimate_tokens(user) + max_tokens,
+                 model="llama-3.3-70b-versatile",
+                 messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
+                 temperature=temperature, max_tokens=max_tokens)
+    return r.choices[0].message.content
+
+def run_llm_tasks(tasks):
+    """tasks: {nombre: (función, args...)}. Cada función recibe limiter= y reserva ella misma lo que envía.
+    Devuelve {nombre: resultado} cuando terminan todas."""
+    limiter = llm_rate_limiter()
+    futures = {llm_executor().submit(fn, *args, limiter=limiter): name for name, (fn, *args) in tasks.items()}
+    return {futures[f]: f.result() for f in as_completed(futures)}
+
+def run_llm_blocks(fn, blocks, ps=None, limiter=None, label="Bloque", max_workers=LLM_WORKERS, on_result=None,
+                   overhead=LLM_PROMPT_TOKENS):
+    """Aplica fn(bloque) a todos los bloques en paralelo bajo los límites por minuto (cada bloque reserva
+    request_tokens(bloque, overhead)) y devuelve (resultados en el orden original, bloques fallidos).
+    Un 429 se reintenta con espera; si aun así un bloque falla se conserva el texto original.
+    El progreso se escribe desde el hilo que llama, a medida que terminan los bloques; on_result(out)
+    recibe la lista parcial (los bloques pendientes aún con su texto original).
+    Desde hilos sin contexto de Streamlit (trabajos) conviene pasar limiter."""
+    if not blocks: return [], 0
+    limiter = limiter or llm_rate_limiter()
+    out, failed, done = list(blocks), 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(blocks)))) as pool:
+        futures = {pool.submit(_limited, limiter, fn, b, tokens=request_tokens(b, overhead)): i
+                   for i, b in enumerate(blocks)}
+        for fut in as_completed(futures):
+            i = futures[fut]; done += 1
+            try: out[i] = fut.result() or blocks[i]
+            except Exception: failed += 1
+            if ps and len(blocks) > 1: ps.write(f"✨ {label} {done}/{len(blocks)}")
+            if on_result and done < len(blocks): on_result(list(out))
+    if ps and failed: ps.write(f"⚠️ {failed} bloque{'s' if failed > 1 else ''} sin corregir (se deja el original)")
+    return out, failed
+
+# Presupuesto de tokens por bloque. La corrección devuelve más o menos lo mismo que recibe, así que
+# el bloque se dimensiona por la salida: estimación × margen nunca pasa de LLM_OUTPUT_CAP.
+LLM_OUTPUT_CAP = 8192
+LLM_BLOCK_TOKENS = 2500
+OUTPUT_MARGIN = 1.25
+
+def estimate_tokens(text):
+    """Estimación conservadora (~3 caracteres por token en español con el tokenizador de LLaMA 3)."""
+    return len(text) // 3 + 1
+
+def output_tokens(text):
+    """max_tokens para corregir text: lo estimado con margen, sin pasar del tope de salida."""
+    return min(LLM_OUTPUT_CAP, int(estimate_tokens(text) * OUTPUT_MARGIN) + 64)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+def pack_blocks(units, budget=LLM_BLOCK_TOKENS):
+    """Agrupa unidades consecutivas (oraciones, segmentos) en bloques de índices de tamaño parecido,
+    cerca de budget tokens y sin pasar de él salvo que una sola unidad ya lo supere."""
+    sizes = [estimate_tokens(u) for u in units]
+    if not sizes: return []
+    n = -(-sum(sizes) // budget)
+    target = min(budget, -(-sum(sizes) // n))  # reparte por igual en vez de dejar un último bloque corto
+    blocks, cur, cur_t = [], [], 0
+    for i, t in enumerate(sizes):
+        if cur and (cur_t + t > budget or (cur_t >= target and len(blocks) < n - 1)):
+            blocks.append(cur); cur, cur_t = [], 0
+        cur.append(i); cur_t += t
+    if cur: blocks.append(cur)
+    return blocks
+
+def _split_long(unit, budget):
+    # Texto sin puntuación (o una oración enorme): se corta entre palabras
+    words, out, cur = unit.split(), [], []
+    for w in words:
+        if cur and estimate_tokens(" ".join(cur + [w])) > budget: out.append(" ".join(cur)); cur = []
+        cur.append(w)
+    if cur: out.append(" ".join(cur))
+    return out
+
+def split_text_blocks(text, budget=LLM_BLOCK_TOKENS, units=None):
+    """Bloques de texto para las pasadas de LLM. Corta en fin de oración o, si se pasan units
+    (los textos de los segmentos), en fin de segmento; nada queda por encima de budget."""
+    if not text or not text.strip(): return []
+    if estimate_tokens(text) <= budget: return [text]
+    units = units if units is not None else _SENTENCE_END.split(text.strip())
+    units = [p for u in units if u.strip() for p in (_split_long(u, budget) if estimate_tokens(u) > budget else [u.strip()])]
+    return [" ".join(units[i] for i in blk) for blk in pack_blocks(units, budget)]
 
 
 # ============================================================
 # POST-PROCESAMIENTO
 # ============================================================
 
+# Frases fantasma conocidas que Whisper genera en silencio (un solo patrón compilado)
+PHANTOM_PHRASES = [
+    "suscríbete", "subscríbete", "subscribe",
+    "gracias por ver", "thanks for watching",
+    "no olvides darle like", "like y suscríbete",
+    "música", "music", "[música]", "[music]",
+    "subtítulos por", "subtitles by",
+]
+_PHANTOM_RE = re.compile("|".join(re.escape(p) for p in PHANTOM_PHRASES))
+
+# Umbrales de las señales de verbose_json (los mismos que usa Whisper para descartar o reintentar)
+NO_SPEECH_MAX = 0.6
+LOGPROB_MIN = -1.0
+COMPRESSION_MAX = 2.4
+
+def signal_suspects(segments):
+    """Motivo de sospecha por segmento según las señales de Whisper ("" si no hay), vectorizado.
+    Silencio: no_speech_prob alto con avg_logprob bajo. Bucle: compression_ratio alto (texto
+    repetitivo). Los segmentos sin señales (caché antigua, modo directo) nunca se marcan."""
+    if not segments: return []
+    sig = np.array([[seg.get(f, np.nan) for f in WHISPER_SIGNALS] for seg in segments], dtype=float)
+    with np.errstate(invalid="ignore"):
+        silence = (sig[:, 0] > NO_SPEECH_MAX) & (sig[:, 1] < LOGPROB_MIN)
+        loop = sig[:, 2] > COMPRESSION_MAX
+    return np.where(silence, "silencio", np.where(loop, "bucle", "")).tolist()
+
+def _mark_suspect(seg, text, reason):
+    seg = dict(seg)
+    seg["hallucination_suspect"] = True; seg["suspect_reason"] = reason
+    seg["text"] = f"[⚠️ segmento dudoso: {text[:60]}]"
+    return seg
+
 # [INTEGRACIÓN MEJORA 2] Filtro de alucinaciones de Whisper
 def filter_hallucinations(segments, min_unique_ratio=0.4, max_repeat_ratio=0.7):
     """
     Detecta y elimina segmentos que probablemente son alucinaciones de Whisper.
     Criterios:
+    - Señales de Whisper: probable silencio o texto en bucle (se marcan, no se eliminan)
     - Segmentos que repiten casi literalmente el anterior (Whisper "se atora")
     - Segmentos con ratio de palabras únicas muy bajo (el modelo repite las mismas 2-3 palabras)
-    - Segmentos sospechosamente cortos en un gap largo de audio
+    - Frases fantasma cortas ("suscríbete", "música"...) típicas de tramos sin voz
+    Los segmentos marcados (hallucination_suspect) no cuentan para la cobertura, así que la
+    recuperación de huecos vuelve a transcribir esos tramos.
     """
     if not segments:
         return segments
 
+    reasons = signal_suspects(segments)
     cleaned = []
-    for i, seg in enumerate(segments):
+    for seg, reason in zip(segments, reasons):
         text = seg.get("text", "").strip()
         if not text:
             continue
 
+        # 1. Señales de Whisper
+        if reason:
+            cleaned.append(_mark_suspect(seg, text, reason))
+            continue
+
         words = text.lower().split()
         n_words = len(words)
 
-        # 1. Segmento demasiado corto para ser real (menos de 2 palabras)
+        # 2. Segmento demasiado corto para juzgarlo por el texto (menos de 2 palabras)
         if n_words < 2:
             cleaned.append(seg)
             continue
 
-        # 2. Ratio de palabras únicas — detecta loops tipo "gracias gracias gracias"
+        # 3. Ratio de palabras únicas — detecta loops tipo "gracias gracias gracias"
         unique_ratio = len(set(words)) / n_words
         if unique_ratio < min_unique_ratio and n_words > 4:
             # Marcar como posible alucinación en lugar de eliminar
-            seg = dict(seg)
-            seg["hallucination_suspect"] = True
-            seg["text"] = f"[⚠️ segmento dudoso: {text[:60]}]"
-            cleaned.append(seg)
+            cleaned.append(_mark_suspect(seg, text, "repetición"))
             continue
 
-        # 3. Comparar con el segmento anterior — Whisper a veces repite el mismo párrafo
+        # 4. Comparar con el segmento anterior — Whisper a veces repite el mismo párrafo
         if cleaned:
-            prev_text = norm(cleaned[-1].get("text", ""))
-            curr_text = norm(text)
-            similarity = SequenceMatcher(None, prev_text, curr_text).ratio()
-            if similarity > max_repeat_ratio:
+            # quick_ratio() es una cota superior barata: solo se calcula ratio() si puede superar el umbral
+            sm = SequenceMatcher(None, seg_norm(cleaned[-1]), seg_norm(seg))
+            if sm.quick_ratio() > max_repeat_ratio and sm.ratio() > max_repeat_ratio:
                 # Es una repetición — descartar el actual
                 continue
 
-        # 4. Frases fantasma conocidas que Whisper genera en silencio
-        PHANTOM_PHRASES = [
-            "suscríbete", "subscríbete", "subscribe",
-            "gracias por ver", "thanks for watching",
-            "no olvides darle like", "like y suscríbete",
-            "música", "music", "[música]", "[music]",
-            "subtítulos por", "subtitles by",
-        ]
-        is_phantom = any(p in text.lower() for p in PHANTOM_PHRASES)
-        if is_phantom and n_words < 8:
+        # 5. Frases fantasma conocidas que Whisper genera en silencio
+        if n_words < 8 and _PHANTOM_RE.search(text.lower()):
             continue
 
         cleaned.append(seg)
 
     return cleaned
 
-def post_correct_with_vocabulary(client, text, segments, custom_vocab):
-    if not custom_vocab or not custom_vocab.strip(): return text, segments
-    vocab_terms = [t.strip() for line in custom_vocab.replace(",", "\n").split("\n") for t in [line.strip()] if t and len(t) > 1]
-    if not vocab_terms: return text, segments
-    vocab_list = ", ".join(vocab_terms)
-    system = (
-        "Eres un corrector de transcripciones de audio. "
-        "El audio puede contener palabras en español, inglés y otros idiomas.\n\n"
-        f"VOCABULARIO CORRECTO:\n{vocab_list}\n\n"
-        "INSTRUCCIONES:\n"
-        "1. Corrige SOLO palabras que sean claramente transcripción errónea del vocabulario.\n"
-        "2. NO cambies palabras no relacionadas. NO agregues ni elimines contenido.\n"
-        "3. Devuelve ÚNICAMENTE el texto corregido, sin explicaciones."
-    )
-    MAX = 5000
-    try:
-        if len(text) <= MAX:
-            r = client.chat.completions.create(model="llama-3.3-70b-versatile",
-                messages=[{"role": "system", "content": system}, {"role": "user", "content": text}],
-                temperature=0.0, max_tokens=4096)
-            corrected = r.choices[0].message.content.strip()
-            for p in ["Aquí", "Texto corregido", "Corrección"]:
-                if corrected.startswith(p) and ":" in corrected[:30]: corrected = corrected.split(":", 1)[1].strip(); break
-            return corrected, realign_segments(corrected, segments)
+# ── Vocabulario: emparejador local (fonética + distancia de edición) ──
+# Encuentra las palabras que suenan como un término del vocabulario. Sin LLM solo se corrige lo que
+# difiere en tildes, mayúsculas o espacios de un nombre que Whisper ya escribió con mayúscula
+# ("Medellin", "Bed out"); el resto (coincidencias solo fonéticas, palabras comunes) se manda al modelo.
+_PHONETIC_RULES = [(re.compile(p), r) for p, r in [
+    (r"ph", "f"), (r"th", "t"), (r"sh", "x"), (r"ch", "x"), (r"ll", "y"), (r"qu", "k"),
+    (r"gu(?=[ei])", "g"), (r"g(?=[ei])", "j"), (r"c(?=[ei])", "s"), (r"[cq]", "k"),
+    (r"z", "s"), (r"v", "b"), (r"w", "u"), (r"h", ""), (r"x", "ks"), (r"y$", "i"),
+    (r"(.)\1+", r"\1"),
+]]
+
+def _plain(text): return re.sub(r"[^\w]", "", norm(text))
+
+@lru_cache(maxsize=65536)
+def phonetic_key(text):
+    """Clave fonética aproximada (español/nombres): b=v, c/s/z, j=g(e,i), h muda, sin dobles."""
+    k = _plain(text)
+    for pat, rep in _PHONETIC_RULES: k = pat.sub(rep, k)
+    return k
+
+def bounded_edit_distance(a, b, max_d):
+    """Levenshtein limitado a la banda |i - j| <= max_d (fuera de ella la distancia ya supera max_d);
+    abandona en cuanto una fila entera la supera. Por encima de max_d devuelve max_d + 1."""
+    la, lb, big = len(a), len(b), max_d + 1
+    if abs(la - lb) > max_d: return big
+    if a == b: return 0
+    prev = [j if j <= max_d else big for j in range(lb + 1)]
+    for i in range(1, la + 1):
+        ca, lo, hi = a[i-1], max(1, i - max_d), min(lb, i + max_d)
+        cur = [big] * (lb + 1); cur[0] = row_min = i if i <= max_d else big
+        for j in range(lo, hi + 1):
+            v = prev[j-1] if ca == b[j-1] else prev[j-1] + 1
+            if prev[j] + 1 < v: v = prev[j] + 1
+            if cur[j-1] + 1 < v: v = cur[j-1] + 1
+            if v > big: v = big
+            cur[j] = v
+            if v < row_min: row_min = v
+        if row_min > max_d: return big
+        prev = cur
+    return prev[lb]
+
+class VocabMatcher:
+    """Índice de los términos del vocabulario por clave fonética y por bigramas de esa clave.
+    match(tokens) recorre el texto con ventanas de 1..n+1 palabras (n = palabras del término
+    más largo, +1 para nombres partidos: "Bed out") y devuelve (i, j, término, exacto), con
+    exacto si la ventana solo difiere del término en tildes, mayúsculas, espacios o puntuación."""
+    def __init__(self, terms):
+        self.terms = list(dict.fromkeys(terms)); self.by_key, self.grams, self._memo = {}, {}, {}
+        self.keys = [phonetic_key(t) for t in self.terms]
+        self.max_words = max((len(t.split()) for t in self.terms), default=0)
+        for ti, key in enumerate(self.keys):
+            self.by_key.setdefault(key, ti)
+            for g in self._bigrams(key): self.grams.setdefault(g, set()).add(ti)
+
+    @staticmethod
+    def _bigrams(key): return {key[i:i+2] for i in range(len(key) - 1)}
+
+    def _candidate(self, key):
+        if key in self._memo: return self._memo[key]
+        if key in self.by_key: best = (self.by_key[key], 0)
         else:
-            sentences = text.split(". "); chunks_t, cur = [], ""
-            for s in sentences:
-                if len(cur) + len(s) < MAX: cur += s + ". "
-                else: chunks_t.append(cur.strip()); cur = s + ". "
-            if cur.strip(): chunks_t.append(cur.strip())
-            parts = []
-            for c in chunks_t:
-                try:
-                    r = client.chat.completions.create(model="llama-3.3-70b-versatile",
-                        messages=[{"role": "system", "content": system}, {"role": "user", "content": c}],
-                        temperature=0.0, max_tokens=4096)
-                    parts.append(r.choices[0].message.content.strip())
-                except: parts.append(c)
-            return " ".join(parts), realign_segments(" ".join(parts), segments)
-    except: return text, segments
-
-def _correct_chunk(client, text):
-    try:
-        r = client.chat.completions.create(model="llama-3.3-70b-versatile",
-            messages=[{"role": "system", "content": "Eres un corrector ortográfico. SOLO corrige tildes, mayúsculas y puntuación. NO cambies, elimines ni agregues palabras. Devuelve únicamente el texto corregido."},
-                      {"role": "user", "content": text}], temperature=0.0)
-        out = r.choices[0].message.content.strip()
-        for p in ["Aquí", "Texto corregido", "Corrección"]:
-            if out.startswith(p) and ":" in out[:30]: out = out.split(":", 1)[1].strip(); break
+            grams = self._bigrams(key); hits = Counter(ti for g in grams for ti in self.grams.get(g, ()))
+            best = None
+            for ti, shared in hits.items():
+                if shared * 2 < len(grams): continue
+                max_d = max(1, len(self.keys[ti]) // 4)
+                d = bounded_edit_distance(key, self.keys[ti], max_d)
+                if d <= max_d and (best is None or d < best[1]): best = (ti, d)
+        self._memo[key] = best; return best
+
+    def match(self, tokens):
+        out, i, n = [], 0, len(tokens)
+        plain = [_plain(t) for t in tokens]
+        while i < n:
+            best = None  # (distancia, ventana, término): gana la menor distancia y, a igualdad, la ventana más corta
+            for w in range(1, min(self.max_words + 1, n - i) + 1):
+                window = plain[i:i+w]
+                if not all(window) or window[0] in STOPWORDS_ES or window[-1] in STOPWORDS_ES: continue
+                key = phonetic_key("".join(window))
+                if len(key) < 4: continue
+                cand = self._candidate(key)
+                if cand and (best is None or cand[1] < best[0]): best = (cand[1], w, self.terms[cand[0]])
+            if not best: i += 1; continue
+            d, w, term = best
+            if " ".join(tokens[i:i+w]).strip(".,;:¡!¿?\"'()") != term:
+                out.append((i, i + w, term, d == 0 and "".join(plain[i:i+w]) == _plain(term)))
+            i += w
         return out
-    except: return text
+
+def _replace_tokens(seg, tokens, i, j, term):
+    lead = re.match(r"^[^\w]*", tokens[i]).group(); trail = re.search(r"[^\w]*$", tokens[j-1]).group()
+    new = (lead + term + trail).split()
+    words = seg.get("words")
+    if words and len(words) == len(tokens):
+        ws, we = words[i][0], words[j-1][1]; step = (we - ws) / len(new)
+        seg["words"] = words[:i] + [[round(ws + k*step, 2), round(ws + (k+1)*step, 2), t] for k, t in enumerate(new)] + words[j:]
+    return tokens[:i] + new + tokens[j:]
+
+_SENTENCE_CLOSE = re.compile(r"[.!?…:][\"'»)]*$")
+
+def _sure_fix(tokens, i, j, exact, prev, common):
+    """Un acierto se aplica sin modelo solo si es exacto salvo tildes/mayúsculas/espacios, la primera
+    palabra ya viene con mayúscula a mitad de frase (no por empezar oración) y no aparece en
+    minúscula en la transcripción, que la delataría como palabra común ("bello", "casa")."""
+    if not exact or not tokens[i].lstrip("¿¡\"'(«")[:1].isupper(): return False
+    if not prev or _SENTENCE_CLOSE.search(prev): return False
+    return _plain(tokens[i]) not in common
+
+def apply_vocab_matcher(segments, vocab_terms):
+    """Aplica los aciertos seguros y devuelve (segmentos, índices de segmentos con dudas)."""
+    if not vocab_terms or not segments: return segments, []
+    matcher, out, doubtful = VocabMatcher(vocab_terms), [], []
+    common = {_plain(t) for seg in segments for t in seg.get("text", "").split() if t[:1].islower()}
+    prev = ""  # última palabra del segmento anterior, para saber si el segmento empieza oración
+    for si, seg in enumerate(segments):
+        tokens = seg.get("text", "").split()
+        hits = matcher.match(tokens) if not seg.get("hallucination_suspect") else []
+        sure = [_sure_fix(tokens, i, j, exact, tokens[i-1] if i else prev, common) for i, j, _, exact in hits]
+        if tokens: prev = tokens[-1]
+        if not all(sure): doubtful.append(si)
+        sure_hits = [h for h, ok in zip(hits, sure) if ok]
+        if not sure_hits: out.append(seg); continue
+        seg = dict(seg)
+        for i, j, term, _ in reversed(sure_hits): tokens = _replace_tokens(seg, tokens, i, j, term)
+        seg["text"] = " ".join(tokens); out.append(seg)
+    return out, doubtful
+
+def segments_text(segments):
+    return " ".join(s["text"] for s in segments if not s.get("hallucination_suspect"))
+
+def _strip_llm_preamble(out):
+    for p in ["Aquí", "Texto corregido", "Corrección"]:
+        if out.startswith(p) and ":" in out[:30]: return out.split(":", 1)[1].strip()
+    return out
+
+ORTHO_SYSTEM = ("Eres un corrector ortográfico. SOLO corrige tildes, mayúsculas y puntuación. "
+                "NO cambies, elimines ni agregues palabras. Devuelve únicamente el texto corregido.")
+
+def correction_system(vocab_terms=None, orthography=True):
+    """Prompt de corrección: solo ortografía, solo vocabulario, o ambos en una sola pasada."""
+    if not vocab_terms: return ORTHO_SYSTEM
+    rules = (["Corrige tildes, mayúsculas y puntuación."] if orthography else []) + [
+        "Corrige SOLO palabras que sean claramente transcripción errónea del vocabulario.",
+        "NO cambies palabras no relacionadas. NO agregues ni elimines contenido.",
+        "Si una palabra común del español encaja en la frase (p. ej. «bello», «casa blanca»), déjala como está.",
+        "Devuelve ÚNICAMENTE el texto corregido, sin explicaciones."]
+    return ("Eres un corrector de transcripciones de audio. "
+            "El audio puede contener palabras en español, inglés y otros idiomas.\n\n"
+            f"VOCABULARIO CORRECTO:\n{', '.join(vocab_terms)}\n\n"
+            "INSTRUCCIONES:\n" + "\n".join(f"{i}. {r}" for i, r in enumerate(rules, 1)))
+
+def _correct_chunk(client, text, system=ORTHO_SYSTEM, max_tokens=None):
+    r = client.chat.completions.create(model="llama-3.3-70b-versatile",
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": text}],
+        temperature=0.0, max_tokens=max_tokens or output_tokens(text))
+    # Una respuesta cortada perdería texto: mejor fallar y que el bloque se quede como estaba
+    if _field(r.choices[0], "finish_reason") == "length": raise ValueError("respuesta truncada")
+    return _strip_llm_preamble(r.choices[0].message.content.strip())
+
+def post_correct_with_vocabulary(client, text, segments, custom_vocab, ps=None, limiter=None):
+    """Devuelve (texto, segmentos, bloques que fallaron y se quedaron como estaban)."""
+    vocab_terms = parse_vocab(custom_vocab)
+    if not vocab_terms: return text, segments, 0
+    fixed, doubtful = apply_vocab_matcher(segments, vocab_terms)
+    n_sure = sum(a["text"] != b["text"] for a, b in zip(segments, fixed))
+    if ps: ps.write(f"🏷️ Vocabulario local: {n_sure} segmentos corregidos · {len(doubtful)} dudosos al modelo")
+    if n_sure: text = segments_text(fixed)
+    if not doubtful: return text, fixed, 0
+    system = correction_system(vocab_terms, orthography=False)
+    try:
+        # Solo los segmentos con dudas van al modelo, empaquetados por presupuesto de tokens
+        groups = [[doubtful[k] for k in blk] for blk in pack_blocks([fixed[si]["text"] for si in doubtful])]
+        outs, failed = run_llm_blocks(lambda b: _correct_chunk(client, b, system),
+                                      [" ".join(fixed[si]["text"] for si in g) for g in groups], ps=ps, limiter=limiter,
+                                      label="Vocabulario", overhead=LLM_PROMPT_TOKENS + estimate_tokens(system))
+        for g, new_text in zip(groups, outs):
+            for si, seg in zip(g, realign_segments(new_text, [fixed[si] for si in g])): fixed[si] = {**fixed[si], **seg}
+        return segments_text(fixed), fixed, failed
+    except: return text, fixed, 1
+
+def _align_key(token):
+    return re.sub(r"[^\w]", "", norm(token))
+
+def _lis_pairs(cand):
+    """Subsecuencia creciente más larga (por j) de pares (i, j) ya ordenados por i."""
+    tails, tails_idx, prev = [], [], [-1] * len(cand)
+    for k, (_, j) in enumerate(cand):
+        pos = bisect.bisect_left(tails, j)
+        if pos == len(tails): tails.append(j); tails_idx.append(k)
+        else: tails[pos] = j; tails_idx[pos] = k
+        prev[k] = tails_idx[pos-1] if pos else -1
+    out, k = [], tails_idx[-1] if tails_idx else -1
+    while k >= 0: out.append(cand[k]); k = prev[k]
+    return out[::-1]
+
+def _resync_align(a, b, alo, ahi, blo, bhi, window=8, confirm=2):
+    """Avance en diagonal para tramos sin anclas únicas: ante una diferencia busca el
+    reenganche más cercano (hasta window tokens de salto) que se confirme con los siguientes."""
+    pairs, i, j = [], alo, blo
+    while i < ahi and j < bhi:
+        if a[i] and a[i] == b[j]: pairs.append((i, j)); i += 1; j += 1; continue
+        best = None
+        for d in range(1, window + 1):
+            for x in range(d + 1):
+                ii, jj = i + x, j + d - x
+                if ii < ahi and jj < bhi and a[ii] and a[ii:ii+confirm] == b[jj:jj+confirm]:
+                    best = (ii, jj); break
+            if best: break
+        if not best: i += 1; j += 1; continue
+        i, j = best
+    return pairs
+
+def align_tokens(a, b, small=4000):
+    """Alineamiento tipo patience diff entre dos listas de tokens normalizados: prefijos y
+    sufijos comunes, luego anclas en tokens únicos en ambos lados (LIS) y recursión entre
+    anclas. Los tramos sin anclas se resuelven con SequenceMatcher si son pequeños y, si no,
+    avanzando en diagonal con reenganche local. Devuelve pares (i, j) crecientes; casi lineal
+    para textos parecidos."""
+    pairs, stack = [], [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        while alo < ahi and blo < bhi and a[alo] and a[alo] == b[blo]:
+            pairs.append((alo, blo)); alo += 1; blo += 1
+        while alo < ahi and blo < bhi and a[ahi-1] and a[ahi-1] == b[bhi-1]:
+            ahi -= 1; bhi -= 1; pairs.append((ahi, bhi))
+        if alo >= ahi or blo >= bhi: continue
+        ca, cb = Counter(a[alo:ahi]), Counter(b[blo:bhi])
+        pos_b = {b[j]: j for j in range(blo, bhi) if b[j] and cb[b[j]] == 1 and ca.get(b[j]) == 1}
+        anchors = _lis_pairs([(i, pos_b[a[i]]) for i in range(alo, ahi) if a[i] in pos_b])
+        if not anchors:
+            if (ahi - alo) * (bhi - blo) <= small:
+                sm = SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+                pairs.extend((alo + m.a + k, blo + m.b + k) for m in sm.get_matching_blocks()
+                             for k in range(m.size) if a[alo + m.a + k])
+            else: pairs.extend(_resync_align(a, b, alo, ahi, blo, bhi))
+            continue
+        pi, pj = alo, blo
+        for i, j in anchors:
+            stack.append((pi, i, pj, j)); pairs.append((i, j)); pi, pj = i + 1, j + 1
+        stack.append((pi, ahi, pj, bhi))
+    pairs.sort()
+    return pairs
 
 def realign_segments(corrected_text, original_segments):
-    words = corrected_text.split()
-    total_orig = sum(len(s["text"].split()) for s in original_segments)
-    if total_orig == 0: return original_segments
-    aligned, idx = [], 0
-    for i, seg in enumerate(original_segments):
-        wc = len(seg["text"].split())
-        if i == len(original_segments) - 1: chunk = words[idx:]
-        else: take = max(1, round((wc / total_orig) * len(words))); chunk = words[idx:idx+take]; idx += len(chunk)
-        aligned.append({"start": seg["start"], "end": seg["end"], "text": " ".join(chunk) if chunk else seg["text"]})
+    """Reparte el texto corregido entre los segmentos originales alineando palabra a palabra:
+    cada palabra corregida hereda el segmento (y la marca de tiempo) de la original con la que
+    casa; las que el modelo añadió se reparten en proporción dentro del tramo entre anclas."""
+    orig, times = [], []
+    for si, seg in enumerate(original_segments):
+        toks, words = seg["text"].split(), seg.get("words")
+        for k, tok in enumerate(toks):
+            orig.append((si, k, tok))
+            # Marca de la palabra original k (exacta si Whisper dio una por token, si no la más cercana)
+            times.append(words[k if len(words) == len(toks) else min(len(words) - 1, round(k * len(words) / len(toks)))]
+                         if words else None)
+    corr = corrected_text.split()
+    if not orig or not corr: return original_segments
+    keys = {t: _align_key(t) for t in {t for _, _, t in orig}.union(corr)}  # norm() una vez por palabra distinta
+    pairs = align_tokens([keys[t] for _, _, t in orig], [keys[t] for t in corr])
+    owner = [0] * len(corr)
+    for (pi, pj), (ni, nj) in zip([(-1, -1)] + pairs, pairs + [(len(orig), len(corr))]):
+        if 0 <= pj < len(corr): owner[pj] = pi
+        run, span = nj - pj - 1, ni - pi - 1
+        for r in range(run):
+            owner[pj + 1 + r] = pi + 1 + r * span // run if span > 0 else min(max(pi, 0), len(orig) - 1)
+    per_seg = [[] for _ in original_segments]
+    for j, i in enumerate(owner):
+        i = min(max(i, 0), len(orig) - 1); per_seg[orig[i][0]].append((j, i))
+    aligned = []
+    for si, seg in enumerate(original_segments):
+        toks = per_seg[si]
+        out = {"start": seg["start"], "end": seg["end"],
+               "text": " ".join(corr[j] for j, _ in toks) if toks else seg["text"]}
+        if seg.get("words"):
+            out["words"] = [[times[i][0], times[i][1], corr[j]] for j, i in toks] if toks else seg["words"]
+        aligned.append(out)
     return aligned
 
-def correct_and_align(client, raw_text, segments):
-    MAX = 5000
-    if len(raw_text) <= MAX: corrected = _correct_chunk(client, raw_text)
-    else:
-        sentences = raw_text.split(". "); chunks, cur = [], ""
-        for s in sentences:
-            if len(cur) + len(s) < MAX: cur += s + ". "
-            else: chunks.append(cur.strip()); cur = s + ". "
-        if cur.strip(): chunks.append(cur.strip())
-        parts = []; bar = st.progress(0, text="Corrigiendo...")
-        for i, c in enumerate(chunks):
-            parts.append(_correct_chunk(client, c))
-            bar.progress((i+1)/len(chunks), text=f"Bloque {i+1}/{len(chunks)}")
-        bar.empty(); corrected = " ".join(parts)
-    return corrected, realign_segments(corrected, segments)
+PARTIAL_MIN_INTERVAL_S = 2.0
+
+def correct_and_align(client, raw_text, segments, ps=None, limiter=None, custom_vocab="", on_partial=None):
+    """Corrección ortográfica por bloques; con vocabulario, ambas instrucciones van en la misma
+    pasada (un solo viaje por bloque y un solo realineado). Con on_partial, los segmentos se
+    publican corregidos hasta donde se va llegando (como mucho cada PARTIAL_MIN_INTERVAL_S).
+    Devuelve (texto, segmentos realineados, bloques que fallaron)."""
+    vocab_terms = parse_vocab(custom_vocab); doubtful_texts = []
+    if vocab_terms:
+        fixed, doubtful = apply_vocab_matcher(segments, vocab_terms)
+        if any(a["text"] != b["text"] for a, b in zip(segments, fixed)): segments, raw_text = fixed, segments_text(fixed)
+        doubtful_texts = [segments[si]["text"] for si in doubtful]
+    # Las instrucciones de vocabulario solo viajan en los bloques que tienen segmentos dudosos
+    fused, ortho = correction_system(vocab_terms), correction_system()
+    def correct_block(b): return _correct_chunk(client, b, fused if any(t in b for t in doubtful_texts) else ortho)
+    # Si el texto es exactamente el de los segmentos, los bloques se cortan en fin de segmento
+    units = [s["text"] for s in segments if not s.get("hallucination_suspect")]
+    blocks = split_text_blocks(raw_text, units=units if " ".join(units) == raw_text else None); last = [time.monotonic()]
+    def publish(out):
+        if time.monotonic() - last[0] < PARTIAL_MIN_INTERVAL_S: return
+        on_partial(realign_segments(" ".join(out), segments), "corrección"); last[0] = time.monotonic()
+    outs, failed = run_llm_blocks(correct_block, blocks, ps=ps, limiter=limiter,
+                                  on_result=publish if on_partial else None,
+                                  overhead=LLM_PROMPT_TOKENS + estimate_tokens(fused))
+    corrected = " ".join(outs)
+    return corrected, realign_segments(corrected, segments), failed
 
 
 # ============================================================
 # BÚSQUEDA
 # ============================================================
-def search_segments(query, segments, corrected_segments, context_words=30, fuzzy_thresh=0.75):
+_WORD_PUNCT = string.punctuation + "¿¡«»…"
+
+def fuzzy_max_dist(n, thresh):
+    """Distancia de edición máxima con la que una palabra de n letras aún puede llegar a thresh."""
+    return int((1 - thresh) * n / thresh + 1e-9)
+
+def _edge_grams(t):
+    p = f"^{t}$"; return {p[k:k+3] for k in range(len(p) - 2)}
+
+class TranscriptIndex:
+    """Índice invertido de una transcripción: token normalizado → posiciones (orden global de palabra),
+    con el segmento de cada posición y un índice de trigramas sobre el vocabulario para buscar
+    subcadenas. Se construye una vez por transcripción; cada búsqueda solo toca los términos
+    candidatos y verifica frases sobre el array de tokens."""
+    def __init__(self, segments):
+        self.segments, self.n_segments = segments, len(segments)
+        self.words = [(w, si) for si, seg in enumerate(segments) for w in seg.get("text", "").split()]
+        self.tokens = [norm(w) for w, _ in self.words]
+        self.seg_first, self.postings = {}, {}
+        for i, (t, (_, si)) in enumerate(zip(self.tokens, self.words)):
+            self.postings.setdefault(t, []).append(i); self.seg_first.setdefault(si, i)
+        self.vocab = sorted(self.postings); self.grams = {}
+        for t in self.vocab:
+            for g in {t[k:k+3] for k in range(len(t) - 2)}: self.grams.setdefault(g, []).append(t)
+        self._cores = self._edge_index = None
+
+    def terms_containing(self, q):
+        if len(q) < 3: return [t for t in self.vocab if q in t]
+        lists = [self.grams.get(q[k:k+3], ()) for k in range(len(q) - 2)]
+        return [t for t in min(lists, key=len) if q in t]
+
+    def terms_with_prefix(self, q):
+        i = bisect.bisect_left(self.vocab, q); out = []
+        while i < len(self.vocab) and self.vocab[i].startswith(q): out.append(self.vocab[i]); i += 1
+        return out
+
+    def similar_terms(self, q, thresh):
+        """Términos cuya palabra (sin puntuación) tiene similitud 1 - d/max(len) >= thresh con q.
+        Con d ediciones se pierden como mucho 3d trigramas de q (con bordes ^ $), así que solo se
+        verifican con bounded_edit_distance los términos que comparten el resto (y al menos uno)."""
+        if self._cores is None:
+            self._cores, self._edge_index = {}, {}
+            for t in self.vocab: self._cores.setdefault(t.strip(_WORD_PUNCT), []).append(t)
+            for c in self._cores:
+                for g in _edge_grams(c): self._edge_index.setdefault(g, []).append(c)
+        if len(q) < 3: return dict.fromkeys(self._cores.get(q, ()) if q else (), 1.0)
+        max_d = fuzzy_max_dist(len(q), thresh); qg = _edge_grams(q)
+        # Con umbrales bajos la cota llega a 0: se exige al menos un trigrama común
+        need = max(1, len(qg) - 3 * max_d)
+        hits = Counter(c for g in qg for c in self._edge_index.get(g, ()))
+        cands = [c for c, n in hits.items() if n >= need and abs(len(c) - len(q)) <= max_d]
+        out = {}
+        for c in cands:
+            d = bounded_edit_distance(q, c, max_d); sc = 1 - d / max(len(q), len(c))
+            if d <= max_d and sc >= thresh: out.update(dict.fromkeys(self._cores[c], sc))
+        return out
+
+    def fuzzy_phrase(self, q_words, thresh):
+        """(posición, similitud media) donde cada palabra de la consulta se parece a la del texto."""
+        sims = [self.similar_terms(w.strip(_WORD_PUNCT), thresh) for w in q_words]
+        if not all(sims): return []
+        n = len(q_words); tk = self.tokens; out = []
+        shift = min(range(n), key=lambda k: sum(len(self.postings[t]) for t in sims[k]))
+        for p in self.positions(sims[shift]):
+            i = p - shift
+            if i < 0 or i + n > len(tk): continue
+            sc = [sims[k].get(tk[i+k]) for k in range(n)]
+            if None not in sc: out.append((i, sum(sc) / n))
+        return out
+
+    def positions(self, terms):
+        return sorted(p for t in terms for p in self.postings[t])
+
+    def phrase(self, q_words):
+        """Posiciones donde empieza la frase: igual que buscar la consulta como subcadena de la
+        ventana de len(q_words) palabras (la primera puede acabar en la consulta y la última empezar)."""
+        n = len(q_words)
+        if n == 1: return self.positions(self.terms_containing(q_words[0]))
+        # Se parte del ancla con menos apariciones: una palabra interior exacta, la primera o la última
+        anchors = [(self.postings.get(w, []), k) for k, w in enumerate(q_words[1:-1], 1)]
+        if any(not p for p, _ in anchors): return []
+        anchors.append((self.positions(t for t in self.terms_containing(q_words[0]) if t.endswith(q_words[0])), 0))
+        anchors.append((self.positions(self.terms_with_prefix(q_words[-1])), n - 1))
+        cand, shift = min(anchors, key=lambda a: len(a[0])); tk = self.tokens; out = []
+        for p in cand:
+            i = p - shift
+            if i < 0 or i + n > len(tk): continue
+            if (tk[i].endswith(q_words[0]) and tk[i+n-1].startswith(q_words[-1])
+                    and all(tk[i+k] == q_words[k] for k in range(1, n - 1))): out.append(i)
+        return out
+
+def transcript_index(segments, key="_search_index"):
+    """Índice de la transcripción activa (o de la vista previa, con otra key), guardado en la sesión;
+    se rehace solo si cambia la lista."""
+    idx = st.session_state.get(key)
+    if idx is None or idx.segments is not segments or idx.n_segments != len(segments):
+        idx = st.session_state[key] = TranscriptIndex(segments)
+    return idx
+
+def search_segments(query, segments, corrected_segments, context_words=30, fuzzy_thresh=0.75, index=None):
     if not query: return []
     target = corrected_segments if corrected_segments else segments
     if not target: return []
     q_norm = norm(query); q_words = q_norm.split()
     if not q_words: return []
-    all_words = [(w, si) for si, seg in enumerate(target) for w in seg.get("text", "").split()]
+    ix = index if index is not None and index.segments is target else TranscriptIndex(target)
+    all_words = ix.words
     if not all_words: return []
-    search_norm = [norm(w) for w, _ in all_words]; found = []
-    for i in range(len(search_norm) - len(q_words) + 1):
-        if q_norm in " ".join(search_norm[i:i+len(q_words)]):
-            found.append({"pos": i, "len": len(q_words), "conf": "high", "score": 1.0, "seg": all_words[i][1]})
+    found = [{"pos": i, "len": len(q_words), "conf": "high", "score": 1.0, "seg": all_words[i][1]}
+             for i in ix.phrase(q_words)]
     if not found:
-        for i, wn in enumerate(search_norm):
-            for qw in q_words:
-                if len(qw) > 2 and qw in wn:
-                    found.append({"pos": i, "len": 1, "conf": "high", "score": 0.95, "seg": all_words[i][1]}); break
+        hits = sorted({p for qw in q_words if len(qw) > 2 for p in ix.positions(ix.terms_containing(qw))})
+        found = [{"pos": i, "len": 1, "conf": "high", "score": 0.95, "seg": all_words[i][1]} for i in hits]
     if not found and fuzzy_thresh < 1.0:
-        offset = 0
-        for si, seg in enumerate(target):
-            st_txt = seg.get("text", ""); sc = SequenceMatcher(None, q_norm, norm(st_txt)).ratio()
-            if sc >= fuzzy_thresh:
-                found.append({"pos": offset, "len": len(st_txt.split()), "conf": "medium" if sc > 0.85 else "low", "score": sc, "seg": si})
-            offset += len(st_txt.split())
+        # La frase con cada palabra parecida y, si no aparece, cada palabra parecida por separado
+        groups = [q_words] if len(q_words) == 1 else [q_words] + [[w] for w in q_words if len(w) > 2]
+        for g in groups:
+            found += [{"pos": i, "len": len(g), "conf": "medium" if sc > 0.85 else "low", "score": sc,
+                       "seg": all_words[i][1]} for i, sc in ix.fuzzy_phrase(g, fuzzy_thresh)]
+            if found and g is q_words: break
     seen, results = set(), []
     for fp in found:
         if fp["seg"] in seen: continue
@@ -1001,9 +2109,11 @@ def search_segments(query, segments, corrected_segments, context_words=30, fuzzy
         p, ln = fp["pos"], fp["len"]
         cs, ce = max(0, p-context_words), min(len(all_words), p+ln+context_words)
         me = min(p+ln, len(all_words))
+        # Con marcas de palabra el salto cae en la palabra encontrada, no al inicio del segmento
+        hit_t = word_time(seg, p - ix.seg_first.get(fp["seg"], p))
         results.append({
-            "start_time": float(seg.get("start", 0)), "end_time": float(seg.get("end", 0)),
-            "time_label": fmt_time(float(seg.get("start", 0))), "end_label": fmt_time(float(seg.get("end", 0))),
+            "start_time": hit_t, "end_time": float(seg.get("end", 0)),
+            "time_label": fmt_time(hit_t), "end_label": fmt_time(float(seg.get("end", 0))),
             "before": " ".join(all_words[j][0] for j in range(cs, p)),
             "match_hl": highlight_html(" ".join(all_words[j][0] for j in range(p, me)), query),
             "after": " ".join(all_words[j][0] for j in range(me, ce)),
@@ -1014,17 +2124,69 @@ def search_segments(query, segments, corrected_segments, context_words=30, fuzzy
         })
     results.sort(key=lambda x: x["score"], reverse=True); return results
 
-def global_search(query, audio_history, fuzzy_thresh=0.75):
-    if not query or not audio_history: return []
-    all_results = []
-    for audio in audio_history:
-        segs = audio.get("corrected_segments") or audio.get("transcript_segments") or []
-        fname = audio.get("uploaded_filename", "audio"); aid = audio.get("id", "")
-        hits = search_segments(query, segs, audio.get("corrected_segments"), context_words=20, fuzzy_thresh=fuzzy_thresh)
-        for h in hits: h["audio_id"] = aid; h["audio_name"] = fname
-        all_results.extend(hits)
-    all_results.sort(key=lambda x: x["score"], reverse=True); return all_results
-
+GLOBAL_SEARCH_LIMIT = 200
+
+def _fts_terms(text): return re.findall(r"\w+", norm(text))
+
+def _fts_quote(term): return '"' + term.replace('"', '""') + '"'
+
+def _global_hits(con, match, limit):
+    return con.execute(
+        "SELECT r.audio_id, r.idx, r.start_s, r.end_s, r.text, a.filename, s.extra, "
+        "p.text AS prev, n.text AS next FROM (SELECT rowid, rank FROM search_fts WHERE search_fts MATCH ? "
+        "ORDER BY rank LIMIT ?) AS m JOIN search_rows r ON r.id = m.rowid JOIN audios a ON a.id = r.audio_id "
+        "LEFT JOIN segments s ON s.audio_id = r.audio_id AND s.kind = 'corrected' AND s.idx = r.idx "
+        "LEFT JOIN search_rows p ON p.audio_id = r.audio_id AND p.idx = r.idx - 1 "
+        "LEFT JOIN search_rows n ON n.audio_id = r.audio_id AND n.idx = r.idx + 1 "
+        "ORDER BY m.rank", (match, limit)).fetchall()
+
+def global_search(query, fuzzy_thresh=0.75, limit=GLOBAL_SEARCH_LIMIT, context_words=20):
+    """Búsqueda en todos los audios guardados sobre el índice FTS5: primero la frase (la última palabra
+    como prefijo) y, si no hay nada, cualquiera de las palabras; resultados ordenados por bm25."""
+    terms = _fts_terms(query)
+    if not terms: return []
+    stages = [(_fts_quote(" ".join(terms)) + "*", len(terms), "high")]
+    long_terms = [t for t in terms if len(t) > 2]
+    if len(terms) > 1 and long_terms:
+        stages.append((" OR ".join(_fts_quote(t) + "*" for t in long_terms), 1, "medium"))
+    rows = []
+    with closing(history_db()) as con:
+        for match, n, conf in stages:
+            rows = _global_hits(con, match, limit)
+            if rows: break
+    if not rows:
+        return _global_scan(query, fuzzy_thresh) if fuzzy_thresh < 1.0 else []
+    results = []
+    for rank, r in enumerate(rows):
+        seg = {"start": r["start_s"], "end": r["end_s"], "text": r["text"]}
+        if r["extra"]: seg.update(json.loads(r["extra"]))
+        words = r["text"].split(); wt = [_fts_terms(w) for w in words]
+        first = terms[0] if n > 1 else None
+        k = next((i for i, ts in enumerate(wt) if any(
+            (t.endswith(first) if first else any(t.startswith(q) for q in long_terms or terms)) for t in ts)), 0)
+        prev, nxt = (r["prev"] or "").split(), (r["next"] or "").split()
+        hit_t = word_time(seg, k)
+        results.append({
+            "audio_id": r["audio_id"], "audio_name": r["filename"] or "audio",
+            "start_time": hit_t, "end_time": float(r["end_s"] or 0),
+            "time_label": fmt_time(hit_t), "end_label": fmt_time(float(r["end_s"] or 0)),
+            "before": " ".join((prev + words[:k])[-context_words:]),
+            "match_hl": highlight_html(" ".join(words[k:k + n]), query),
+            "after": " ".join((words[k + n:] + nxt)[:context_words]),
+            "confidence": conf, "score": 1.0 - rank / (2 * len(rows)), "idx": r["idx"],
+            "full_segment": r["text"], "prev_segment": r["prev"] or "", "next_segment": r["next"] or "",
+        })
+    return results
+
+def _global_scan(query, fuzzy_thresh):
+    """Respaldo aproximado cuando el índice no encuentra la consulta: recorre los audios recientes."""
+    results = []
+    for audio in history_list(HISTORY_PAGE):
+        segs = history_segments(audio["id"], "corrected") or history_segments(audio["id"], "raw")
+        hits = search_segments(query, segs, None, context_words=20, fuzzy_thresh=fuzzy_thresh)
+        for h in hits: h["audio_id"] = audio["id"]; h["audio_name"] = audio["uploaded_filename"]
+        results.extend(hits)
+    results.sort(key=lambda x: x["score"], reverse=True); return results
 
 # ============================================================
 # IA: ENTIDADES — VERSIÓN ROBUSTA
@@ -1085,11 +2247,19 @@ def _parse_entities_json(raw_content):
 def extract_entities(client, text):
     if st.session_state.entities is not None:
         return st.session_state.entities
+    result, error = _extract_entities(client, text)
+    _store_entities(result, error)
+    return result
 
+def _store_entities(result, error):
+    # Un fallo sin ninguna entidad no se guarda: queda pendiente para reintentar
+    st.session_state._entities_error = error
+    if not error or any(result.values()): st.session_state.entities = result
+
+def _extract_entities(client, text, limiter=None):
+    """Llamada al modelo sin tocar la sesión (puede correr en un hilo). Devuelve (entidades, error)."""
     if not isinstance(text, str) or not text.strip():
-        fallback = {k: [] for k in ["personas", "organizaciones", "lugares", "fechas", "otros"]}
-        st.session_state.entities = fallback
-        return fallback
+        return {k: [] for k in ["personas", "organizaciones", "lugares", "fechas", "otros"]}, None
 
     text_to_analyze = text[:8000] if len(text) > 8000 else text
 
@@ -1117,17 +2287,8 @@ No incluyas explicaciones, comentarios ni bloques de código markdown."""
     for attempt in range(3):
         try:
             temp = 0.0 if attempt == 0 else (0.1 if attempt == 1 else 0.2)
-            r = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": f"Extrae las entidades de este texto:\n\n{text_to_analyze}"}
-                ],
-                temperature=temp,
-                max_tokens=1000
-            )
-
-            raw_content = r.choices[0].message.content
+            raw_content = llm_chat(client, system, f"Extrae las entidades de este texto:\n\n{text_to_analyze}",
+                                   1000, temperature=temp, limiter=limiter)
             parsed = _parse_entities_json(raw_content)
 
             if parsed is not None:
@@ -1138,20 +2299,18 @@ No incluyas explicaciones, comentarios ni bloques de código markdown."""
                         result[key] = [str(item).strip() for item in val if item and str(item).strip()]
                     else:
                         result[key] = []
-                st.session_state.entities = result
-                return result
+                return result, None
 
             last_error = f"No se pudo parsear el JSON en intento {attempt + 1}"
 
+        except RateLimitError as e:
+            last_error = str(e); break  # llm_chat ya esperó y reintentó
         except Exception as e:
             last_error = str(e)
             if attempt < 2:
                 time.sleep(1)
 
-    st.session_state._entities_error = last_error
-    fallback = {k: [] for k in ["personas", "organizaciones", "lugares", "fechas", "otros"]}
-    st.session_state.entities = fallback
-    return fallback
+    return {k: [] for k in ["personas", "organizaciones", "lugares", "fechas", "otros"]}, last_error
 
 
 def highlight_entities_in_text(text, entities):
@@ -1200,11 +2359,11 @@ def render_entity_panel(entities):
 # ============================================================
 def generate_lead(client, text, filename=""):
     if st.session_state.lead_cache is not None: return st.session_state.lead_cache
+    return _store_analysis("lead", _generate_lead(client, text))
 
+def _generate_lead(client, text, limiter=None):
     if not isinstance(text, str) or not text.strip():
-        fallback = {"titular": "Sin texto", "subtitulo": "", "lead": "No hay texto para analizar.", "contexto": ""}
-        st.session_state.lead_cache = fallback
-        return fallback
+        return {"titular": "Sin texto", "subtitulo": "", "lead": "No hay texto para analizar.", "contexto": ""}
 
     system = """Eres un periodista experto en redacción noticiosa.
 Con base en la siguiente transcripción de audio, redacta:
@@ -1221,15 +2380,7 @@ Responde ÚNICAMENTE con un objeto JSON válido, sin texto adicional:
   "contexto": "..."
 }"""
     try:
-        r = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": text[:10000]}
-            ],
-            temperature=0.2, max_tokens=600
-        )
-        raw = r.choices[0].message.content.strip()
+        raw = llm_chat(client, system, text[:10000], 600, temperature=0.2, limiter=limiter).strip()
         raw = re.sub(r"```(?:json)?\s*", "", raw)
         raw = re.sub(r"```\s*", "", raw).strip()
 
@@ -1238,118 +2389,312 @@ Responde ÚNICAMENTE con un objeto JSON válido, sin texto adicional:
             result = json.loads(brace_match.group())
         else:
             result = json.loads(raw)
-
-        st.session_state.lead_cache = result
         return result
     except Exception as e:
-        fallback = {
-            "titular": "No se pudo generar",
-            "subtitulo": "",
-            "lead": f"Error al generar el lead: {str(e)[:100]}",
-            "contexto": ""
-        }
-        st.session_state.lead_cache = fallback
-        return fallback
+        return {"error": f"Error al generar el lead: {str(e)[:100]}"}
 
 
 # ============================================================
 # IA: ANÁLISIS
 # ============================================================
-def ai_generate(client, system_prompt, user_content, max_tokens=2048, temp=0.1):
-    try:
-        r = client.chat.completions.create(model="llama-3.3-70b-versatile",
-            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
-            temperature=temp, max_tokens=max_tokens)
-        return r.choices[0].message.content.strip()
+def ai_generate(client, system_prompt, user_content, max_tokens=2048, temp=0.1, limiter=None):
+    try: return llm_chat(client, system_prompt, user_content, max_tokens, temperature=temp, limiter=limiter).strip()
     except Exception as e: return f"Error: {e}"
 
-def generate_summary(client, text):
-    if "summary" in st.session_state.analysis_cache: return st.session_state.analysis_cache["summary"]
-    system = ("Eres un asistente experto en crear resúmenes claros en español. "
-              "Genera un resumen ejecutivo con este formato:\n\n"
-              "## Resumen Ejecutivo\nUn párrafo conciso con lo más importante.\n\n"
-              "## Puntos Clave\nLista de los puntos más importantes (máximo 7).\n\n"
-              "## Conclusiones\nConclusiones principales del contenido.")
-    result = ai_generate(client, system, text[:12000])
-    st.session_state.analysis_cache["summary"] = result; return result
-
-def generate_topics(client, text):
-    if "topics" in st.session_state.analysis_cache: return st.session_state.analysis_cache["topics"]
-    system = ("Analiza la siguiente transcripción y extrae:\n\n"
-              "## Temas Principales\nLista los temas principales discutidos.\n\n"
-              "## Palabras Clave\nEntre 10 y 15 palabras clave relevantes.\n\n"
-              "## Categoría del Contenido\nClasifica el tipo de contenido.\n\nResponde en español.")
-    result = ai_generate(client, system, text[:12000])
-    st.session_state.analysis_cache["topics"] = result; return result
-
-def generate_action_items(client, text):
-    if "actions" in st.session_state.analysis_cache: return st.session_state.analysis_cache["actions"]
-    system = ("Extrae de la siguiente transcripción:\n\n"
-              "## Tareas y Acciones Pendientes\nAcciones mencionadas.\n\n"
-              "## Decisiones Tomadas\nDecisiones durante la conversación.\n\n"
-              "## Preguntas Abiertas\nPreguntas sin responder.\n\n"
-              "## Compromisos\nCompromisos asumidos.\n\nResponde en español.")
-    result = ai_generate(client, system, text[:12000])
-    st.session_state.analysis_cache["actions"] = result; return result
-
-def generate_sentiment(client, text):
-    if "sentiment" in st.session_state.analysis_cache: return st.session_state.analysis_cache["sentiment"]
-    system = ("Analiza tono y sentimiento:\n\n"
-              "## Tono General\nDescribe el tono.\n\n"
-              "## Sentimiento\nPositivo, negativo, neutro o mixto.\n\n"
-              "## Momentos Destacados\nMomentos donde el tono cambia.\n\n"
-              "## Nivel de Formalidad (1-10)\n\nResponde en español.")
-    result = ai_generate(client, system, text[:12000])
-    st.session_state.analysis_cache["sentiment"] = result; return result
+ANALYSIS_PROMPTS = {
+    "summary": ("Eres un asistente experto en crear resúmenes claros en español. "
+                "Genera un resumen ejecutivo con este formato:\n\n"
+                "## Resumen Ejecutivo\nUn párrafo conciso con lo más importante.\n\n"
+                "## Puntos Clave\nLista de los puntos más importantes (máximo 7).\n\n"
+                "## Conclusiones\nConclusiones principales del contenido."),
+    "topics": ("Analiza la siguiente transcripción y extrae:\n\n"
+               "## Temas Principales\nLista los temas principales discutidos.\n\n"
+               "## Palabras Clave\nEntre 10 y 15 palabras clave relevantes.\n\n"
+               "## Categoría del Contenido\nClasifica el tipo de contenido.\n\nResponde en español."),
+    "actions": ("Extrae de la siguiente transcripción:\n\n"
+                "## Tareas y Acciones Pendientes\nAcciones mencionadas.\n\n"
+                "## Decisiones Tomadas\nDecisiones durante la conversación.\n\n"
+                "## Preguntas Abiertas\nPreguntas sin responder.\n\n"
+                "## Compromisos\nCompromisos asumidos.\n\nResponde en español."),
+    "sentiment": ("Analiza tono y sentimiento:\n\n"
+                  "## Tono General\nDescribe el tono.\n\n"
+                  "## Sentimiento\nPositivo, negativo, neutro o mixto.\n\n"
+                  "## Momentos Destacados\nMomentos donde el tono cambia.\n\n"
+                  "## Nivel de Formalidad (1-10)\n\nResponde en español."),
+}
+
+def _store_analysis(kind, result):
+    """Guarda un análisis (o el lead) del audio. Los errores no se guardan: quedan en _analysis_errors
+    para mostrarlos y el análisis sigue pendiente."""
+    error = result.get("error") if isinstance(result, dict) else (result if result.startswith("Error:") else None)
+    if error: st.session_state._analysis_errors[kind] = error; return result
+    st.session_state._analysis_errors.pop(kind, None)
+    if kind == "lead": st.session_state.lead_cache = result
+    else: st.session_state.analysis_cache[kind] = result
+    return result
+
+def _generate_analysis(client, kind, text):
+    if kind in st.session_state.analysis_cache: return st.session_state.analysis_cache[kind]
+    return _store_analysis(kind, ai_generate(client, ANALYSIS_PROMPTS[kind], text[:12000]))
+
+def generate_summary(client, text): return _generate_analysis(client, "summary", text)
+def generate_topics(client, text): return _generate_analysis(client, "topics", text)
+def generate_action_items(client, text): return _generate_analysis(client, "actions", text)
+def generate_sentiment(client, text): return _generate_analysis(client, "sentiment", text)
+
+
+def analyze_all(client, text):
+    """Entidades, lead y los cuatro análisis a la vez; solo se piden los que faltan."""
+    tasks = {kind: (ai_generate, client, prompt, text[:12000])
+             for kind, prompt in ANALYSIS_PROMPTS.items() if kind not in st.session_state.analysis_cache}
+    if st.session_state.entities is None: tasks["entities"] = (_extract_entities, client, text)
+    if st.session_state.lead_cache is None: tasks["lead"] = (_generate_lead, client, text)
+    if not tasks: return
+    results = run_llm_tasks(tasks)
+    if "entities" in results: _store_entities(*results.pop("entities"))
+    for kind, result in results.items(): _store_analysis(kind, result)
 
 
 # ============================================================
 # PROCESO PRINCIPAL
 # ============================================================
-def process_audio(client, uploaded, model, do_correct, custom_vocab=""):
-    history_save_current()
-    st.session_state.active_audio_id = history_new_id()
-    reset_current_audio()
-    with st.status("Procesando audio...", expanded=True) as status:
-        path = save_uploaded(uploaded)
-        if not path: st.error("Error al guardar"); return False
-        size_mb = os.path.getsize(path) / (1024*1024)
-        st.write(f"📁 {uploaded.name} — {size_mb:.1f} MB")
-        st.session_state.uploaded_filename = uploaded.name
-        st.session_state.custom_vocabulary = custom_vocab
-        converted_path, was_converted = convert_to_mp3(path, status_writer=status)
-        st.session_state.audio_path = path
-        whisper_prompt = build_prompt_vocabulary(custom_vocab)
-        full_text, segments, duration_ms, coverage, gaps, chunks_used = transcribe_complete(
-            client, converted_path, model, prompt=whisper_prompt, ps=status)
-        if was_converted and converted_path != path:
-            try: os.remove(converted_path)
-            except: pass
-        if not full_text or not segments: st.error("Error en transcripción"); return False
-        st.session_state.raw_transcript = full_text
-        st.session_state.transcript_segments = segments
-        st.session_state.audio_duration_ms = duration_ms
-        st.session_state.coverage_pct = coverage
-        st.session_state.transcript_gaps = gaps
-        st.session_state.chunks_used = chunks_used
-        if custom_vocab and custom_vocab.strip():
-            st.write("🏷️ Aplicando vocabulario...")
-            full_text, segments = post_correct_with_vocabulary(client, full_text, segments, custom_vocab)
-        if do_correct:
-            st.write("✨ Corrigiendo ortografía...")
-            txt, csegs = correct_and_align(client, full_text, segments)
-            st.session_state.transcript_text = txt
-            st.session_state.corrected_segments = csegs
-            st.session_state.correction_applied = True
-        else:
-            st.session_state.transcript_text = full_text
-            st.session_state.corrected_segments = segments
-            st.session_state.correction_applied = False
-        st.session_state.audio_start_time = 0; st.session_state._audio_widget_key = 0
-        wc = len(full_text.split())
-        cov_icon = "✅" if coverage >= 95 else "⚠️" if coverage >= 80 else "❌"
-        status.update(label=f"{cov_icon} {wc:,} palabras · {coverage:.0f}% cobertura", state="complete", expanded=False)
-    history_save_current(); return True
+RESULT_FIELDS = ["raw_transcript", "transcript_segments", "audio_duration_ms", "coverage_pct", "transcript_gaps",
+                 "chunks_used", "transcript_text", "corrected_segments", "correction_applied"]
+
+def process_audio(client, path, filename, model, do_correct, custom_vocab="", max_workers=MAX_PARALLEL_CHUNKS, ps=None,
+                  codec=UPLOAD_CODEC, limiter=None, on_partial=None):
+    """Pipeline completo (caché → transcripción en partes → vocabulario → corrección).
+    No toca st.session_state, así puede correr en un hilo de fondo; el progreso va a ps.write()
+    y, si se pasa on_partial(segmentos, etapa), los segmentos parciales según van saliendo.
+    Devuelve un dict con RESULT_FIELDS más nombre, ruta y vocabulario, o None si falla."""
+    base = {"uploaded_filename": filename, "custom_vocabulary": custom_vocab, "audio_path": path}
+    size_mb = os.path.getsize(path) / (1024*1024)
+    if ps: ps.write(f"📁 {filename} — {size_mb:.1f} MB")
+    whisper_prompt = build_prompt_vocabulary(custom_vocab)
+    fingerprint, silences = audio_fingerprint(path)
+    result_key = cache_key("result", fingerprint, model, whisper_prompt, custom_vocab, bool(do_correct)) if fingerprint else None
+    cached = cache_get(result_key) if result_key else None
+    if cached:
+        if ps: ps.write(f"⚡ {len(cached['raw_transcript'].split()):,} palabras · desde caché")
+        return {**cached, **base}
+    full_text, segments, duration_ms, coverage, gaps, chunks_used, failed = transcribe_complete(
+        client, path, model, prompt=whisper_prompt, ps=ps, max_workers=max_workers,
+        fingerprint=fingerprint, silences=silences, codec=codec, on_partial=on_partial)
+    if not full_text or not segments: return None
+    result = {"raw_transcript": full_text, "transcript_segments": segments, "audio_duration_ms": duration_ms,
+              "coverage_pct": coverage, "transcript_gaps": gaps, "chunks_used": chunks_used}
+    has_vocab = bool(parse_vocab(custom_vocab))
+    if do_correct:
+        if ps: ps.write("✨ Corrigiendo ortografía" + (" y vocabulario..." if has_vocab else "..."))
+        txt, csegs, bad = correct_and_align(client, full_text, segments, ps=ps, limiter=limiter,
+                                            custom_vocab=custom_vocab, on_partial=on_partial)
+        failed += bad
+        result.update(transcript_text=txt, corrected_segments=csegs, correction_applied=True)
+    else:
+        if has_vocab:
+            if ps: ps.write("🏷️ Aplicando vocabulario...")
+            full_text, segments, bad = post_correct_with_vocabulary(client, full_text, segments, custom_vocab, ps=ps,
+                                                                    limiter=limiter)
+            failed += bad
+        result.update(transcript_text=full_text, corrected_segments=segments, correction_applied=False)
+    # Un resultado con partes o bloques fallidos no se guarda: al reintentar, la caché por parte
+    # evita repetir lo que sí salió y solo se vuelve a pedir lo que falló
+    if result_key and not failed:
+        cache_put(result_key, {**result, **{k: public_segments(result[k]) for k in ("transcript_segments", "corrected_segments")}})
+    elif result_key and ps: ps.write(f"⚠️ {failed} parte{'s' if failed > 1 else ''} o bloque{'s' if failed > 1 else ''} "
+                                     "con error: el resultado no se guarda en caché")
+    wc = len(full_text.split())
+    cov_icon = "✅" if coverage >= 95 else "⚠️" if coverage >= 80 else "❌"
+    if ps: ps.write(f"{cov_icon} {wc:,} palabras · {coverage:.0f}% cobertura")
+    return {**result, **base}
+
+
+# ============================================================
+# TRABAJOS EN SEGUNDO PLANO
+# ============================================================
+# Cada audio subido se procesa como un trabajo en un pool del proceso (compartido entre
+# sesiones). El estado y el log de progreso quedan en la tabla jobs, así un refresco del
+# navegador no corta el trabajo y cualquier sesión puede seguirlo o abrir el resultado.
+JOB_WORKERS = int(os.environ.get("TRANSCRIPTOR_JOB_WORKERS", "2"))
+JOB_ACTIVE = ("pendiente", "procesando")
+JOB_ICONS = {"pendiente": "🕒", "procesando": "⏳", "listo": "✅", "error": "❌", "interrumpido": "⚠️"}
+
+# Los audios subidos se guardan junto al historial (el reproductor los usa al abrir el resultado) y
+# se borran cuando su trabajo lleva más de UPLOAD_KEEP_DAYS terminado o ya no pertenecen a ninguno.
+UPLOAD_DIR = os.environ.get("TRANSCRIPTOR_UPLOAD_DIR") or os.path.join(os.path.dirname(HISTORY_DB) or ".", "uploads")
+UPLOAD_KEEP_DAYS = float(os.environ.get("TRANSCRIPTOR_UPLOAD_DAYS", "7"))
+UPLOAD_ORPHAN_GRACE_S = 3600  # un archivo recién guardado aún no tiene su fila en jobs
+UPLOAD_NAME = re.compile(r"up_\d+_")  # nombre que pone submit_uploads; el resto de la carpeta no se toca
+# Cada trabajo activo guarda el arranque del proceso que lo ejecuta. Va en el entorno del proceso para
+# sobrevivir a la recarga del módulo y a limpiar la caché, que reconstruyen job_executor sin reiniciar.
+BOOT_ID = os.environ.setdefault("TRANSCRIPTOR_BOOT_ID", f"{os.getpid()}_{time.time_ns()}")
+
+def _drop_upload(con, path):
+    try: os.remove(path)
+    except OSError: pass
+    con.execute("UPDATE jobs SET path = NULL WHERE path = ?", (path,))
+
+def uploads_gc():
+    """Aplica la retención de los audios subidos según la tabla jobs."""
+    cutoff = (datetime.now() - timedelta(days=UPLOAD_KEEP_DAYS)).isoformat()
+    with closing(history_db()) as con, con:
+        for r in con.execute("SELECT DISTINCT path FROM jobs WHERE path IS NOT NULL AND status NOT IN (?, ?) "
+                             "AND updated_at < ?", (*JOB_ACTIVE, cutoff)).fetchall():
+            _drop_upload(con, r["path"])
+        used = {r["path"] for r in con.execute("SELECT path FROM jobs WHERE path IS NOT NULL")}
+    if not os.path.isdir(UPLOAD_DIR): return
+    now = time.time()
+    for fn in os.listdir(UPLOAD_DIR):
+        p = os.path.join(UPLOAD_DIR, fn)
+        if not UPLOAD_NAME.match(fn): continue
+        try:
+            if p not in used and now - os.path.getmtime(p) > UPLOAD_ORPHAN_GRACE_S: os.remove(p)
+        except OSError: pass
+
+@st.cache_resource
+def job_executor():
+    # Un proceso nuevo no tiene hilos para los trabajos que otro proceso dejó a medias; los de este
+    # proceso siguen en el pool anterior aunque la caché se haya reconstruido
+    with closing(history_db()) as con, con:
+        con.execute("UPDATE jobs SET status = 'interrumpido', updated_at = ? WHERE status IN (?, ?) "
+                    "AND boot IS NOT ?", (datetime.now().isoformat(), *JOB_ACTIVE, BOOT_ID))
+    uploads_gc()
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="tcr_job")
+
+@st.cache_resource
+def job_partials():
+    """Segmentos parciales de los trabajos en curso, en memoria: {job_id: {segments, stage}}."""
+    return {}
+
+class JobProgress:
+    """Escritor compatible con st.status: cada write() se añade al log del trabajo."""
+    def __init__(self, job_id): self.job_id = job_id
+    def write(self, msg): job_update(self.job_id, log=str(msg))
+
+def job_update(job_id, status=None, log=None, error=None):
+    sets, args = ["updated_at = ?"], [datetime.now().isoformat()]
+    if status: sets.append("status = ?"); args.append(status)
+    if status in JOB_ACTIVE: sets.append("boot = ?"); args.append(BOOT_ID)
+    if log: sets.append("log = log || ?"); args.append(log + "\n")
+    if error is not None: sets.append("error = ?"); args.append(error)
+    with closing(history_db()) as con, con:
+        con.execute(f"UPDATE jobs SET {', '.join(sets)} WHERE id = ?", (*args, job_id))
+
+def _job_from_row(row):
+    job = dict(row); job["params"] = json.loads(job["params"] or "{}")
+    job["log"] = [l for l in (job["log"] or "").split("\n") if l]
+    return job
+
+def job_get(job_id):
+    with closing(history_db()) as con:
+        row = con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_from_row(row) if row else None
+
+def job_list(limit=8):
+    with closing(history_db()) as con:
+        rows = con.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+    return [_job_from_row(r) for r in rows]
+
+def job_count_active():
+    with closing(history_db()) as con:
+        return con.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", JOB_ACTIVE).fetchone()[0]
+
+def _job_run(job_id, client, limiter=None, partials=None):
+    job = job_get(job_id)
+    if not job: return
+    job_update(job_id, status="procesando", error="")
+    def publish(segments, stage):
+        if partials is not None: partials[job_id] = {"segments": segments, "stage": stage}
+    try:
+        prm = job["params"]
+        result = process_audio(client, job["path"], job["filename"], prm["model"], prm["do_correct"],
+                               prm.get("custom_vocab", ""), prm.get("max_workers", MAX_PARALLEL_CHUNKS),
+                               ps=JobProgress(job_id), codec=prm.get("codec", UPLOAD_CODEC), limiter=limiter,
+                               on_partial=publish)
+        if not result: job_update(job_id, status="error", error="Error en transcripción"); return
+        history_save(job["audio_id"], {**AUDIO_DEFAULTS, **result}, with_segments=True)
+        job_update(job_id, status="listo")
+    except Exception as e: job_update(job_id, status="error", error=str(e)[:300])
+    finally:
+        if partials is not None: partials.pop(job_id, None)
+        try: uploads_gc()
+        except Exception: pass
+
+def job_submit(client, path, filename, model, do_correct, custom_vocab="", max_workers=MAX_PARALLEL_CHUNKS,
+               codec=UPLOAD_CODEC):
+    pool = job_executor()  # antes del INSERT: la primera llamada marca como interrumpidos los activos
+    job_id = f"job_{int(time.time() * 1000)}_{os.urandom(2).hex()}"; now = datetime.now().isoformat()
+    params = {"model": model, "do_correct": bool(do_correct), "custom_vocab": custom_vocab, "max_workers": max_workers,
+              "codec": codec}
+    with closing(history_db()) as con, con:
+        con.execute("INSERT INTO jobs (id, audio_id, filename, path, params, status, created_at, updated_at, boot) "
+                    "VALUES (?, ?, ?, ?, ?, 'pendiente', ?, ?, ?)",
+                    (job_id, history_new_id() + job_id[-4:], filename, path, json.dumps(params, ensure_ascii=False), now, now,
+                     BOOT_ID))
+    pool.submit(_job_run, job_id, client, llm_rate_limiter(), job_partials())
+    return job_id
+
+def job_retry(client, job_id):
+    """Relanza un trabajo fallido o interrumpido; la caché por chunk evita repetir lo ya transcrito."""
+    pool = job_executor()
+    job = job_get(job_id)
+    if not job or not os.path.isfile(job["path"] or ""): return False
+    job_update(job_id, status="pendiente", log="🔁 Reintentando...")
+    pool.submit(_job_run, job_id, client, llm_rate_limiter(), job_partials())
+    return True
+
+def submit_uploads(client, files, model, do_correct, custom_vocab="", max_workers=MAX_PARALLEL_CHUNKS,
+                   codec=UPLOAD_CODEC):
+    for f in files:
+        path = save_uploaded(f, prefix=f"up_{int(time.time() * 1000)}_", directory=UPLOAD_DIR)
+        if not path: st.error(f"Error al guardar {f.name}"); continue
+        st.session_state.my_jobs.append(job_submit(client, path, f.name, model, do_correct, custom_vocab, max_workers, codec))
+
+def render_jobs_panel(client, context_words=30, fuzzy_thresh=0.75):
+    jobs = job_list()
+    mine = st.session_state.my_jobs
+    shown = [j for j in jobs if j["status"] in JOB_ACTIVE or j["id"] in mine or j["status"] in ("error", "interrumpido")]
+    # El último trabajo de esta sesión se abre solo al terminar
+    if mine:
+        last = job_get(mine[-1])
+        if last and last["status"] == "listo" and last["id"] not in st.session_state._opened_jobs:
+            st.session_state._opened_jobs.append(last["id"])
+            history_save_current(); history_load(last["audio_id"]); st.rerun()
+    if not shown: return
+    with st.expander(f"⏳ Trabajos ({sum(1 for j in shown if j['status'] in JOB_ACTIVE)} en curso)", expanded=True):
+        for j in shown:
+            jc1, jc2 = st.columns([5, 1])
+            with jc1:
+                last_line = j["log"][-1] if j["log"] else ""
+                detail = j["error"] if j["status"] == "error" and j["error"] else last_line
+                st.markdown(f"<div class='hist-card-name'>{JOB_ICONS.get(j['status'], '•')} {j['filename']}</div>"
+                            f"<div class='hist-card-meta'>{j['status']} · {detail}</div>", unsafe_allow_html=True)
+            with jc2:
+                if j["status"] == "listo" and j["audio_id"] != st.session_state.active_audio_id:
+                    if st.button("Abrir", key=f"jo_{j['id']}", use_container_width=True):
+                        history_save_current(); history_load(j["audio_id"]); st.rerun()
+                elif j["status"] in ("error", "interrumpido"):
+                    if st.button("🔁", key=f"jr_{j['id']}", use_container_width=True, help="Reintentar"):
+                        if not job_retry(client, j["id"]): st.warning("El archivo original ya no está disponible")
+                        st.rerun()
+        # Vista previa del trabajo propio más reciente que ya tiene segmentos: se puede leer y buscar
+        # mientras sigue la transcripción o la corrección
+        partials = job_partials()
+        live = next((j for j in shown if j["id"] in mine and j["id"] in partials), None)
+        if live:
+            part = partials[live["id"]]; psegs = part["segments"]
+            st.markdown(f"<div class='hist-card-name'>👀 Vista previa · {live['filename']}</div>"
+                        f"<div class='hist-card-meta'>{part['stage']} · {len(psegs)} segmentos · "
+                        f"hasta {fmt_time(psegs[-1]['end'] if psegs else 0)}</div>", unsafe_allow_html=True)
+            pq = st.text_input("Buscar en la vista previa", key="partial_query", placeholder="🔍 Buscar en lo ya transcrito...",
+                               label_visibility="collapsed").strip()
+            if pq and psegs:
+                # La misma búsqueda que el resultado terminado (índice, substring, fuzzy) sobre lo ya publicado
+                pres = search_segments(pq, psegs, None, context_words=context_words, fuzzy_thresh=fuzzy_thresh,
+                                       index=transcript_index(psegs, "_partial_index"))
+                with st.container(height=320, border=False): render_search_results(pres, pq, jump=False)
+            else:
+                render_segment_viewer(psegs, max_height="320px")
 
 
 # ============================================================
@@ -1364,7 +2709,7 @@ def render_segment_viewer(segments, active_idx=-1, search_query="", max_height="
         text = seg.get("text", "").strip()
         
         # [FILTRO REAL] Si hay un término de búsqueda, omitir el segmento si no contiene la coincidencia
-        if q_norm and q_norm not in norm(text):
+        if q_norm and q_norm not in seg_norm(seg):
             continue
             
         display_text = highlight_html(text, search_query) if search_query else text
@@ -1378,6 +2723,32 @@ def render_segment_viewer(segments, active_idx=-1, search_query="", max_height="
     else:
         st.markdown(f"<div class='seg-viewer' style='max-height:{max_height}'>{''.join(rows)}</div>", unsafe_allow_html=True)
 
+def render_search_results(res, aq, total_occ=None, jump=True):
+    """Tarjetas de resultados de search_segments. jump=False quita el botón de salto (vista previa
+    de un trabajo: su audio aún no está en el reproductor)."""
+    if aq and res:
+        occ = f" ({total_occ} ocurrencias)" if total_occ is not None else ""
+        st.caption(f"**{len(res)}** resultado{'s' if len(res) != 1 else ''}{occ} para **{aq}**")
+        for r in res:
+            badge_cls = f"sr-badge-{r.get('confidence', 'low')}"
+            bh = f"<span class='sr-ctx'>...{r.get('before', '')} </span>" if r.get('before') else ""
+            ah = f"<span class='sr-ctx'> {r.get('after', '')}...</span>" if r.get('after') else ""
+            ctx = ""
+            if r.get('prev_segment') or r.get('next_segment'):
+                cp = []
+                if r.get('prev_segment'):
+                    cp.append(f"<span class='sr-ctx'>↑ {highlight_html(r['prev_segment'], aq)}</span>")
+                if r.get('next_segment'):
+                    cp.append(f"<span class='sr-ctx'>↓ {highlight_html(r['next_segment'], aq)}</span>")
+                ctx = f"<div class='sr-segment-full'>{'<br>'.join(cp)}</div>"
+            ts_btn = make_ts_button_html(max(0, r.get("start_time", 0) - 2), label=r.get('time_label', '0:00')) if jump else ""
+            st.markdown(f"""<div class="sr-card"><div class="sr-head">{ts_btn}
+                <span class="sr-time" style="margin-left:4px">{r.get('time_label', '')} → {r.get('end_label', '')}</span>
+                <span class="sr-badge {badge_cls}">{r.get('confidence', 'low')}</span></div>
+                <div class="sr-body">{bh}{r.get('match_hl', '')}{ah}</div>{ctx}</div>""", unsafe_allow_html=True)
+    elif aq and res is not None and len(res) == 0:
+        st.markdown('<div class="no-results-box">🔍 Sin resultados.</div>', unsafe_allow_html=True)
+
 
 # ============================================================
 # STOPWORDS
@@ -1421,6 +2792,12 @@ def main_app():
         model = st.selectbox("Modelo Whisper", ["whisper-large-v3", "whisper-large-v3-turbo"],
                              format_func=lambda x: "V3 Precisión" if "turbo" not in x else "V3 Turbo")
         do_correct = st.toggle("Corrección ortográfica", value=True)
+        parallel = st.slider("Partes en paralelo", 1, 8, MAX_PARALLEL_CHUNKS,
+                             help="Número máximo de partes que se envían a Whisper a la vez")
+        codecs = [c for c in UPLOAD_PROFILES if not check_upload_profile(c)]
+        codec = st.selectbox("Códec de subida", codecs, index=codecs.index(UPLOAD_CODEC) if UPLOAD_CODEC in codecs else 0,
+                             format_func=lambda c: UPLOAD_PROFILES[c]["label"],
+                             help="Formato en que se envía cada parte a Whisper; Opus reduce la subida a una fracción")
         st.markdown("---")
         st.markdown("##### 📝 Vocabulario")
         custom_vocab = st.text_area("Vocabulario", value=st.session_state.get("custom_vocabulary", ""),
@@ -1441,21 +2818,19 @@ def main_app():
         st.markdown("##### ➕ Subir nuevo audio")
 
         if st.session_state.transcript_text:
-            if len(st.session_state.audio_history) >= MAX_HISTORY:
-                st.caption(f"⚠️ Historial lleno ({MAX_HISTORY} audios). Elimina uno desde la pestaña Global.")
-            else:
-                new_file_sidebar = st.file_uploader(
-                    "Selecciona un archivo de audio:",
-                    type=["mp3", "wav", "m4a", "ogg", "mp4"],
-                    label_visibility="visible",
-                    key="upload_sidebar"
-                )
-                if new_file_sidebar:
-                    st.info(f"Seleccionado: **{new_file_sidebar.name}**")
-                    vocab_sb = st.session_state.get("custom_vocabulary", "") or custom_vocab
-                    if st.button("🚀 Transcribir este audio", type="primary", use_container_width=True, key="proc_sidebar"):
-                        if process_audio(client, new_file_sidebar, model, do_correct, custom_vocab=vocab_sb):
-                            st.rerun()
+            new_files_sidebar = st.file_uploader(
+                "Selecciona archivos de audio:",
+                type=["mp3", "wav", "m4a", "ogg", "mp4"],
+                label_visibility="visible",
+                accept_multiple_files=True,
+                key="upload_sidebar"
+            )
+            if new_files_sidebar:
+                st.info(f"Seleccionado{'s' if len(new_files_sidebar) > 1 else ''}: **{', '.join(f.name for f in new_files_sidebar)}**")
+                vocab_sb = st.session_state.get("custom_vocabulary", "") or custom_vocab
+                if st.button("🚀 Transcribir", type="primary", use_container_width=True, key="proc_sidebar"):
+                    submit_uploads(client, new_files_sidebar, model, do_correct, custom_vocab=vocab_sb, max_workers=parallel, codec=codec)
+                    st.rerun()
         else:
             st.caption("Sube tu primer audio en el centro de la pantalla ↓")
 
@@ -1475,14 +2850,15 @@ def main_app():
     </div>""", unsafe_allow_html=True)
 
     # ── HISTORIAL ──
-    hist = st.session_state.audio_history
+    hist = history_list(HISTORY_BAR_LIMIT)[::-1]
+    n_hist = history_count() if hist else 0
     if hist:
         chips = "<div class='hist-bar'>"
         for h in hist:
             active = h["id"] == st.session_state.active_audio_id
             cls = "hist-chip active" if active else "hist-chip"
             fn = h.get("uploaded_filename", "audio")[:22]
-            dur = fmt_duration(get_audio_duration(h.get("corrected_segments") or []))
+            dur = fmt_duration(h["duration"])
             chips += f"<span class='{cls}'><span class='hist-chip-dot'></span>{fn} <span style='opacity:0.7'>· {dur}</span></span>"
         st.markdown(chips + "</div>", unsafe_allow_html=True)
         if len(hist) > 1:
@@ -1497,6 +2873,10 @@ def main_app():
                     else:
                         st.button(f"✓ {fn}", key=f"active_{h['id']}", use_container_width=True, disabled=True)
 
+    # ── TRABAJOS ── (se refresca solo mientras haya trabajos en curso)
+    job_executor()
+    st.fragment(run_every=2.0 if job_count_active() else None)(render_jobs_panel)(client, ctx_w, fuzzy_t if use_fuzzy else 1.0)
+
     # ── SIN TRANSCRIPCIÓN (PANTALLA INICIAL) ──
     if not st.session_state.transcript_text:
         _, col_c, _ = st.columns([1, 2, 1])
@@ -1504,13 +2884,15 @@ def main_app():
             st.markdown('<div class="empty-state"><div class="empty-state-icon">📂</div>'
                         '<div class="empty-state-title">Sube un archivo de audio</div>'
                         '<div class="empty-state-text">MP3, WAV, M4A, OGG o MP4</div></div>', unsafe_allow_html=True)
-            uploaded = st.file_uploader("x", type=["mp3","wav","m4a","ogg","mp4"], label_visibility="collapsed", key="upload_initial")
+            uploaded = st.file_uploader("x", type=["mp3","wav","m4a","ogg","mp4"], label_visibility="collapsed",
+                                        accept_multiple_files=True, key="upload_initial")
             st.markdown("---")
             with st.expander("📝 Vocabulario personalizado", expanded=False):
                 initial_vocab = st.text_area("Vocabulario", placeholder="Bedout\nstreaming", height=100, label_visibility="collapsed", key="initial_vocab")
             if uploaded and st.button("🚀 Transcribir", type="primary", use_container_width=True):
                 vocab = st.session_state.get("initial_vocab", "") or custom_vocab
-                if process_audio(client, uploaded, model, do_correct, custom_vocab=vocab): st.rerun()
+                submit_uploads(client, uploaded, model, do_correct, custom_vocab=vocab, max_workers=parallel, codec=codec)
+                st.rerun()
         return
 
     # ══════════════════════════════════════════════
@@ -1538,7 +2920,7 @@ def main_app():
 
     with left_col:
         # ── REPRODUCTOR ──
-        if st.session_state.audio_path:
+        if st.session_state.audio_path and os.path.isfile(st.session_state.audio_path):
             st.markdown("<div class='panel-header'>🎵 Reproductor</div>", unsafe_allow_html=True)
             st.markdown(f"<div style='font-size:0.72rem;color:var(--text-secondary);margin-bottom:4px'>📁 <strong>{fname_display[:28]}</strong></div>", unsafe_allow_html=True)
             st.audio(st.session_state.audio_path, start_time=st.session_state.audio_start_time)
@@ -1622,40 +3004,21 @@ def main_app():
                     st.rerun()
 
             if st.session_state.get("_search_pending"):
+                search_target = st.session_state.corrected_segments or st.session_state.transcript_segments
                 st.session_state.search_results = search_segments(
                     st.session_state.last_search_query,
                     st.session_state.transcript_segments,
                     st.session_state.corrected_segments,
                     context_words=ctx_w,
-                    fuzzy_thresh=fuzzy_t if use_fuzzy else 1.0
+                    fuzzy_thresh=fuzzy_t if use_fuzzy else 1.0,
+                    index=transcript_index(search_target) if search_target else None
                 )
                 st.session_state._search_pending = False
 
             aq = st.session_state.last_search_query
             res = st.session_state.search_results
 
-            if aq and res:
-                total_occ = count_occurrences(txt, aq)
-                st.caption(f"**{len(res)}** resultado{'s' if len(res) != 1 else ''} ({total_occ} ocurrencias) para **{aq}**")
-                for i, r in enumerate(res):
-                    badge_cls = f"sr-badge-{r.get('confidence', 'low')}"
-                    bh = f"<span class='sr-ctx'>...{r.get('before', '')} </span>" if r.get('before') else ""
-                    ah = f"<span class='sr-ctx'> {r.get('after', '')}...</span>" if r.get('after') else ""
-                    ctx = ""
-                    if r.get('prev_segment') or r.get('next_segment'):
-                        cp = []
-                        if r.get('prev_segment'):
-                            cp.append(f"<span class='sr-ctx'>↑ {highlight_html(r['prev_segment'], aq)}</span>")
-                        if r.get('next_segment'):
-                            cp.append(f"<span class='sr-ctx'>↓ {highlight_html(r['next_segment'], aq)}</span>")
-                        ctx = f"<div class='sr-segment-full'>{'<br>'.join(cp)}</div>"
-                    ts_btn = make_ts_button_html(max(0, r.get("start_time", 0) - 2), label=r.get('time_label', '0:00'))
-                    st.markdown(f"""<div class="sr-card"><div class="sr-head">{ts_btn}
-                        <span class="sr-time" style="margin-left:4px">{r.get('time_label', '')} → {r.get('end_label', '')}</span>
-                        <span class="sr-badge {badge_cls}">{r.get('confidence', 'low')}</span></div>
-                        <div class="sr-body">{bh}{r.get('match_hl', '')}{ah}</div>{ctx}</div>""", unsafe_allow_html=True)
-            elif aq and res is not None and len(res) == 0:
-                st.markdown('<div class="no-results-box">🔍 Sin resultados.</div>', unsafe_allow_html=True)
+            render_search_results(res, aq, count_occurrences(txt, aq) if aq and res else None)
 
             st.markdown("---")
             st.markdown("##### 📄 Texto completo")
@@ -1692,8 +3055,8 @@ def main_app():
                             _ = generate_lead(client, txt, fname_display)
                         st.rerun()
 
-                if st.session_state.get("_entities_error") and st.session_state.entities is not None:
-                    all_empty = all(len(v) == 0 for v in st.session_state.entities.values() if isinstance(v, list))
+                if st.session_state.get("_entities_error"):
+                    all_empty = all(len(v) == 0 for v in (st.session_state.entities or {}).values() if isinstance(v, list))
                     if all_empty:
                         st.markdown(
                             f"<div class='ent-error-box'>⚠️ No se pudieron extraer entidades. "
@@ -1707,6 +3070,9 @@ def main_app():
                         st.markdown("---")
                         render_entity_panel(st.session_state.entities)
 
+                if "lead" in st.session_state._analysis_errors:
+                    st.markdown(f"<div class='ent-error-box'>⚠️ {st.session_state._analysis_errors['lead']}</div>",
+                                unsafe_allow_html=True)
                 if st.session_state.lead_cache:
                     st.markdown("---")
                     lead = st.session_state.lead_cache
@@ -1741,10 +3107,10 @@ def main_app():
         # TAB: GLOBAL
         # ════════════════════════════════════════
         with tab_global:
-            if len(hist) <= 1:
+            if n_hist <= 1:
                 st.markdown('<div class="empty-state"><div class="empty-state-icon">🌐</div>'
                             '<div class="empty-state-title">Agrega más audios</div>'
-                            '<div class="empty-state-text">Necesitas al menos 2 en sesión. Sube otro archivo desde el menú lateral expandido.</div></div>', unsafe_allow_html=True)
+                            '<div class="empty-state-text">Necesitas al menos 2 guardados. Sube otro archivo desde el menú lateral expandido.</div></div>', unsafe_allow_html=True)
             else:
                 def execute_global_search():
                     q = st.session_state.get("gq_input", "").strip()
@@ -1755,12 +3121,11 @@ def main_app():
                         st.session_state.global_search_results = None
                         st.session_state.last_global_query = ""
 
-                st.text_input("gq", placeholder=f"Buscar en {len(hist)} archivos...", label_visibility="collapsed", key="gq_input", on_change=execute_global_search)
+                st.text_input("gq", placeholder=f"Buscar en {n_hist} archivos...", label_visibility="collapsed", key="gq_input", on_change=execute_global_search)
 
                 if st.session_state.get("_global_search_pending"):
                     st.session_state.global_search_results = global_search(
-                        st.session_state.last_global_query, hist,
-                        fuzzy_thresh=fuzzy_t if use_fuzzy else 1.0
+                        st.session_state.last_global_query, fuzzy_thresh=fuzzy_t if use_fuzzy else 1.0
                     )
                     st.session_state._global_search_pending = False
 
@@ -1793,11 +3158,30 @@ def main_app():
                     st.markdown('<div class="no-results-box">🔍 Sin resultados.</div>', unsafe_allow_html=True)
 
                 st.markdown("---")
-                st.markdown("##### 📚 Audios en sesión")
-                for h in hist:
+                st.markdown("##### 📚 Audios guardados")
+                hist_name = ""
+                if n_hist > HISTORY_PAGE:
+                    hist_name = st.text_input("hf", placeholder="🔍 Filtrar por nombre de archivo...", label_visibility="collapsed",
+                                              key="hist_filter", on_change=lambda: st.session_state.update(hist_page=0)).strip()
+                n_match = history_count(hist_name) if hist_name else n_hist
+                n_pages = max(1, -(-n_match // HISTORY_PAGE))
+                page = min(st.session_state.hist_page, n_pages - 1)
+                if n_pages > 1:
+                    pc1, pc2, pc3 = st.columns([1, 3, 1])
+                    with pc1:
+                        if st.button("◀ Recientes", key="hist_prev", disabled=page == 0):
+                            st.session_state.hist_page = page - 1; st.rerun()
+                    with pc2:
+                        st.caption(f"Página {page + 1} de {n_pages} · {n_match:,} audios")
+                    with pc3:
+                        if st.button("Anteriores ▶", key="hist_next", disabled=page >= n_pages - 1):
+                            st.session_state.hist_page = page + 1; st.rerun()
+                elif hist_name and not n_match:
+                    st.caption("Ningún audio coincide con el filtro")
+                for h in history_list(HISTORY_PAGE, page * HISTORY_PAGE, hist_name):
                     active = h["id"] == st.session_state.active_audio_id
-                    dur = fmt_duration(get_audio_duration(h.get("corrected_segments") or []))
-                    wc = len((h.get("transcript_text") or "").split())
+                    dur = fmt_duration(h["duration"])
+                    wc = h["word_count"]
                     hc1, hc2, hc3 = st.columns([3, 1, 1])
                     with hc1:
                         st.markdown(f"<div class='hist-card {'active' if active else ''}'><div class='hist-card-name'>📁 {h.get('uploaded_filename', 'audio')}{' ← activo' if active else ''}</div><div class='hist-card-meta'>⏱ {dur} · {wc:,} palabras</div></div>", unsafe_allow_html=True)
@@ -1808,10 +3192,11 @@ def main_app():
                             st.rerun()
                     with hc3:
                         if st.button("🗑", key=f"hd_{h['id']}"):
-                            st.session_state.audio_history = [x for x in st.session_state.audio_history if x["id"] != h["id"]]
-                            if active and st.session_state.audio_history:
-                                history_load(st.session_state.audio_history[-1]["id"])
-                            elif not st.session_state.audio_history:
+                            history_delete(h["id"])
+                            remaining = history_list(1)
+                            if active and remaining:
+                                history_load(remaining[0]["id"])
+                            elif not remaining:
                                 reset_current_audio()
                                 st.session_state.active_audio_id = None
                             st.rerun()
@@ -1847,12 +3232,11 @@ def main_app():
                                  f"1. Solo información explícita.\n2. Incluye [MM:SS].\n"
                                  f"3. Si no está: 'No encontré esa información.'\n4. NO inventes.\n"
                                  f"\nTRANSCRIPCIÓN:\n{ts_ctx}{ent_ctx}")
-                        stream = client.chat.completions.create(
+                        chat_msgs = [{"role": m["role"], "content": m["content"]} for m in st.session_state.chat_history[-6:]]
+                        stream = _limited(llm_rate_limiter(), client.chat.completions.create,
+                                          tokens=estimate_tokens(sys_p + "".join(m["content"] for m in chat_msgs)) + 2048,
                             model="llama-3.3-70b-versatile",
-                            messages=[
-                                {"role": "system", "content": sys_p},
-                                *[{"role": m["role"], "content": m["content"]} for m in st.session_state.chat_history[-6:]]
-                            ],
+                            messages=[{"role": "system", "content": sys_p}, *chat_msgs],
                             stream=True, max_tokens=2048, temperature=0.1
                         )
                         for chunk in stream:
@@ -1882,11 +3266,19 @@ def main_app():
                 <div class="kpi-card"><div class="kpi-value">{coverage:.0f}%</div><div class="kpi-label">Cobertura</div></div>
             </div>""", unsafe_allow_html=True)
             st.markdown("---")
+            pending = [k for k in ANALYSIS_PROMPTS if k not in st.session_state.analysis_cache]
+            pending += [k for k, v in (("entities", st.session_state.entities), ("lead", st.session_state.lead_cache)) if v is None]
+            if st.button("⚡ Generar todo a la vez", use_container_width=True, disabled=not pending,
+                         help="Resumen, temas, tareas, tono, entidades y lead en paralelo"):
+                with st.spinner(f"Generando {len(pending)} análisis en paralelo..."):
+                    analyze_all(client, txt)
+                st.rerun()
             an1, an2 = st.columns(2)
             with an1:
                 if st.button("📝 Resumen", use_container_width=True, type="primary"):
                     with st.spinner("Generando..."):
                         generate_summary(client, txt)
+                if "summary" in st.session_state._analysis_errors: st.error(st.session_state._analysis_errors["summary"])
                 if "summary" in st.session_state.analysis_cache:
                     with st.expander("📝 Resumen", expanded=True):
                         st.markdown(st.session_state.analysis_cache["summary"])
@@ -1894,6 +3286,7 @@ def main_app():
                 if st.button("🏷️ Temas", use_container_width=True, type="primary"):
                     with st.spinner("Extrayendo..."):
                         generate_topics(client, txt)
+                if "topics" in st.session_state._analysis_errors: st.error(st.session_state._analysis_errors["topics"])
                 if "topics" in st.session_state.analysis_cache:
                     with st.expander("🏷️ Temas", expanded=True):
                         st.markdown(st.session_state.analysis_cache["topics"])
@@ -1903,6 +3296,7 @@ def main_app():
                 if st.button("✅ Tareas y Decisiones", use_container_width=True):
                     with st.spinner("Extrayendo..."):
                         generate_action_items(client, txt)
+                if "actions" in st.session_state._analysis_errors: st.error(st.session_state._analysis_errors["actions"])
                 if "actions" in st.session_state.analysis_cache:
                     with st.expander("✅ Tareas", expanded=True):
                         st.markdown(st.session_state.analysis_cache["actions"])
@@ -1910,6 +3304,7 @@ def main_app():
                 if st.button("🎭 Análisis de Tono", use_container_width=True):
                     with st.spinner("Analizando..."):
                         generate_sentiment(client, txt)
+                if "sentiment" in st.session_state._analysis_errors: st.error(st.session_state._analysis_errors["sentiment"])
                 if "sentiment" in st.session_state.analysis_cache:
                     with st.expander("🎭 Tono", expanded=True):
                         st.markdown(st.session_state.analysis_cache["sentiment"])
@@ -1939,13 +3334,7 @@ def main_app():
                 st.download_button("📄 Texto (.txt)", data=txt,
                                    file_name=f"{fname_display}_transcripcion.txt", mime="text/plain", use_container_width=True)
             with c2:
-                srt = []
-                for i, seg in enumerate(segs):
-                    s, e = float(seg.get("start", 0)), float(seg.get("end", 0))
-                    srt.extend([f"{i+1}",
-                                f"{int(s//3600):02d}:{int((s%3600)//60):02d}:{s%60:06.3f} --> {int(e//3600):02d}:{int((e%3600)//60):02d}:{e%60:06.3f}",
-                                seg.get("text", ""), ""])
-                st.download_button("🎬 Subtítulos (.srt)", data="\n".join(srt),
+                st.download_button("🎬 Subtítulos (.srt)", data=build_srt(segs),
                                    file_name=f"{fname_display}.srt", mime="text/plain", use_container_width=True)
             with c3:
                 ts_lines = [f"[{fmt_time(float(seg.get('start', 0)))}] {seg.get('text', '')}" for seg in segs]
@@ -1954,12 +3343,8 @@ def main_app():
             st.markdown("---")
             c4, c5 = st.columns(2)
             with c4:
-                json_data = {
-                    "filename": fname_display, "date": datetime.now().isoformat(),
-                    "duration_seconds": duration, "word_count": n_words,
-                    "coverage_percent": coverage, "entities": st.session_state.entities,
-                    "lead": st.session_state.lead_cache, "full_text": txt, "segments": segs
-                }
+                json_data = build_export_json(fname_display, txt, segs, coverage,
+                                              entities=st.session_state.entities, lead=st.session_state.lead_cache)
                 st.download_button("🗂️ JSON completo", data=json.dumps(json_data, ensure_ascii=False, indent=2),
                                    file_name=f"{fname_display}.json", mime="application/json", use_container_width=True)
             with c5:
@@ -1972,15 +3357,116 @@ def main_app():
                     st.button("📊 Análisis (.json)", disabled=True, use_container_width=True)
             if len(hist) > 1:
                 st.markdown("---")
+                states = [history_state(h["id"]) or {} for h in hist]
                 se = {
                     "session_date": datetime.now().isoformat(), "total_audios": len(hist),
-                    "audios": [{"filename": h.get("uploaded_filename"), "full_text": h.get("transcript_text", ""),
-                                "lead": h.get("lead_cache"), "entities": h.get("entities")} for h in hist]
+                    "audios": [{"filename": h.get("uploaded_filename"), "full_text": hs.get("transcript_text", ""),
+                                "lead": hs.get("lead_cache"), "entities": hs.get("entities")} for h, hs in zip(hist, states)]
                 }
                 st.download_button("📦 Sesión completa (.json)", data=json.dumps(se, ensure_ascii=False, indent=2),
                                    file_name="sesion_completa.json", mime="application/json", use_container_width=True)
 
 
+# ============================================================
+# CLI (procesamiento por lotes, sin interfaz)
+# ============================================================
+# python app_estable.py <carpeta|glob|archivo>... -o salida/
+# Pensado para rellenar archivos históricos de noche: varios audios a la vez, cada uno
+# con sus partes en paralelo, y la misma caché en disco que usa la app.
+AUDIO_EXTS = (".mp3", ".wav", ".m4a", ".ogg", ".mp4")
+
+class CliProgress:
+    """Escritor compatible con st.status que imprime en stderr con el nombre del audio."""
+    def __init__(self, name): self.name = name
+    def write(self, msg): sys.stderr.write(f"[{self.name}] {msg}\n"); sys.stderr.flush()
+
+def _glob_root(pattern):
+    """Carpeta fija de un glob (lo anterior a la primera parte con comodines)."""
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part): break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+def collect_audio_files(inputs):
+    """Audios de las entradas como (ruta, nombre de salida sin extensión). El nombre reproduce la ruta
+    relativa a la carpeta o glob de entrada, así dos boletin.mp3 de subcarpetas distintas no se pisan;
+    si aun así coinciden (varias entradas, otra extensión) se numeran: boletin_2."""
+    files, taken = {}, set()
+    for item in inputs:
+        if os.path.isdir(item):
+            root, matches = item, [os.path.join(r, f) for r, _, names in os.walk(item) for f in names]
+        else:
+            matches = glob.glob(item, recursive=True) or [item]
+            root = _glob_root(item) if glob.has_magic(item) else os.path.dirname(item) or "."
+        for m in sorted(matches):
+            if m in files or not (m.lower().endswith(AUDIO_EXTS) and os.path.isfile(m)): continue
+            rel = base = os.path.splitext(os.path.relpath(m, root))[0]; n = 1
+            while rel in taken: n += 1; rel = f"{base}_{n}"
+            taken.add(rel); files[m] = rel
+    return list(files.items())
+
+def batch_process_file(client, path, args, vocab, limiter=None, rel=None):
+    name = os.path.basename(path); rel = rel or os.path.splitext(name)[0]
+    label = os.path.join(os.path.dirname(rel), name)
+    outputs = {fmt: os.path.join(args.out, f"{rel}.{fmt}") for fmt in args.formats}
+    if args.skip_existing and all(os.path.isfile(o) for o in outputs.values()):
+        CliProgress(label).write("⏭️ Ya procesado"); return True
+    result = process_audio(client, path, name, args.model, not args.no_correct, custom_vocab=vocab,
+                           max_workers=args.parallel, ps=CliProgress(label), codec=args.codec, limiter=limiter)
+    if not result: CliProgress(label).write("❌ Error en transcripción"); return False
+    txt, segs = result["transcript_text"], result["corrected_segments"]
+    data = {"json": lambda: json.dumps(build_export_json(name, txt, segs, result["coverage_pct"]), ensure_ascii=False, indent=2),
+            "srt": lambda: build_srt(segs), "txt": lambda: txt}
+    for fmt, out in outputs.items():
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        with open(out, "w", encoding="utf-8") as fp: fp.write(data[fmt]())
+    if args.history:
+        history_save(f"cli_{int(time.time() * 1000)}_{os.urandom(2).hex()}", {**AUDIO_DEFAULTS, **result}, with_segments=True)
+    return True
+
+def batch_main(argv=None):
+    ap = argparse.ArgumentParser(prog="app_estable.py", description="Transcribe audios por lotes (JSON/SRT como en Exportar).")
+    ap.add_argument("inputs", nargs="+", help="carpetas, globs o archivos de audio")
+    ap.add_argument("-o", "--out", default="transcripciones", help="carpeta de salida")
+    ap.add_argument("-m", "--model", default="whisper-large-v3", choices=["whisper-large-v3", "whisper-large-v3-turbo"])
+    ap.add_argument("-j", "--jobs", type=int, default=JOB_WORKERS, help="audios procesados a la vez")
+    ap.add_argument("-p", "--parallel", type=int, default=MAX_PARALLEL_CHUNKS, help="partes en paralelo por audio")
+    ap.add_argument("-c", "--codec", default=UPLOAD_CODEC, help=f"códec de subida: {', '.join(UPLOAD_PROFILES)}")
+    ap.add_argument("-f", "--formats", default="json,srt", help="lista separada por comas: json,srt,txt")
+    ap.add_argument("--vocab", default="", help="vocabulario personalizado, o @archivo para leerlo")
+    ap.add_argument("--no-correct", action="store_true", help="omite la corrección ortográfica")
+    ap.add_argument("--skip-existing", action="store_true", help="salta audios con todas sus salidas ya escritas")
+    ap.add_argument("--history", action="store_true", help="guarda también cada resultado en el historial")
+    args = ap.parse_args(argv)
+    args.formats = [f.strip().lower() for f in args.formats.split(",") if f.strip()]
+    if bad := [f for f in args.formats if f not in ("json", "srt", "txt")]: ap.error(f"formato no soportado: {', '.join(bad)}")
+    if err := check_upload_profile(args.codec): ap.error(err)
+    vocab = args.vocab
+    if vocab.startswith("@"):
+        with open(vocab[1:], encoding="utf-8") as fp: vocab = fp.read()
+    api_key = os.environ.get("GROQ_API_KEY")
+    if not api_key:
+        try: api_key = st.secrets["general"]["groq_api_key"]
+        except Exception: ap.error("define GROQ_API_KEY o .streamlit/secrets.toml")
+    files = collect_audio_files(args.inputs)
+    if not files: ap.error("no se encontraron audios")
+    os.makedirs(args.out, exist_ok=True)
+    client = Groq(api_key=api_key); t0 = time.time(); ok = 0
+    print(f"🎙️ {len(files)} audios · {args.jobs} a la vez · {args.parallel} partes por audio", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        limiter = llm_rate_limiter()  # compartido por todos los audios del lote
+        futures = {pool.submit(batch_process_file, client, f, args, vocab, limiter, rel): rel for f, rel in files}
+        for fut in as_completed(futures):
+            try: ok += bool(fut.result())
+            except Exception as e: CliProgress(futures[fut]).write(f"❌ {e}")
+    print(f"✅ {ok}/{len(files)} audios en {fmt_duration(time.time() - t0)} → {args.out}", file=sys.stderr)
+    return 0 if ok == len(files) else 1
+
+
 if __name__ == "__main__":
+    # Con `streamlit run` hay runtime; con `python app_estable.py ...` se usa la CLI
+    if not st.runtime.exists():
+        sys.exit(batch_main())
     if check_password():
         main_app()
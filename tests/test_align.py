@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+WORDS = ("el alcalde dijo que la reforma de la salud llega al concejo de medellin esta semana y los "
+         "concejales piden mas tiempo para revisar el presupuesto").split()
+
+
+def _segments(n, rng):
+    segs, t = [], 0.0
+    for _ in range(n):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+        segs.append({"start": t, "end": t + 4.0, "text": text}); t += 4.0
+    return segs
+
+
+def _edit(tokens, rng, rate=0.1):
+    out = []
+    for t in tokens:
+        r = rng.random()
+        if r < rate / 3: continue
+        if r < 2 * rate / 3: out.append(t.capitalize() + ","); continue
+        out.append(t)
+        if r < rate: out.append(rng.choice(WORDS))
+    return out
+
+
+def test_align_tokens_pairs_are_monotonic_equal_and_near_sequencematcher():
+    rng = random.Random(3)
+    for _ in range(30):
+        a = [rng.choice(WORDS) for _ in range(rng.randint(50, 400))]
+        b = _edit(a, rng)
+        pairs = app.align_tokens(a, b)
+        assert all(a[i] == b[j] for i, j in pairs)
+        assert all(p[0] < q[0] and p[1] < q[1] for p, q in zip(pairs, pairs[1:]))
+        ref = sum(m.size for m in SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks())
+        assert len(pairs) >= 0.95 * ref
+
+
+def test_realign_keeps_segment_count_and_word_order():
+    rng = random.Random(7)
+    for n in (1, 5, 60):
+        segs = _segments(n, rng)
+        corrected = " ".join(_edit(app.segments_text(segs).split(), rng))
+        out = app.realign_segments(corrected, segs)
+        assert len(out) == len(segs)
+        assert [(s["start"], s["end"]) for s in out] == [(s["start"], s["end"]) for s in segs]
+        assert " ".join(s["text"] for s in out if s["text"]).split() == corrected.split()
+
+
+def test_realign_keeps_each_corrected_word_in_its_segment():
+    segs = [{"start": 0.0, "end": 3.0, "text": "el alcalde de medellin"},
+            {"start": 3.0, "end": 6.0, "text": "hablo de la reforma"},
+            {"start": 6.0, "end": 9.0, "text": "en el concejo"}]
+    out = app.realign_segments("El alcalde de Medellín habló de la reforma en el Concejo.", segs)
+    assert [s["text"] for s in out] == ["El alcalde de Medellín", "habló de la reforma", "en el Concejo."]
@@ -0,0 +1,48 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fp: fp.write(b"\0")
+
+
+def _args(out, skip_existing=False):
+    return SimpleNamespace(out=str(out), formats=["json", "txt"], skip_existing=skip_existing, model="whisper-large-v3",
+                           no_correct=True, parallel=1, codec=app.UPLOAD_CODEC, history=False)
+
+
+def test_duplicate_stems_get_distinct_outputs(tmp_path, monkeypatch):
+    src = tmp_path / "a"
+    for month in ("01", "02"): _touch(str(src / "2023" / month / "boletin.mp3"))
+    _touch(str(src / "2023" / "01" / "boletin.wav"))
+    files = app.collect_audio_files([str(src)])
+    assert sorted(rel for _, rel in files) == sorted([os.path.join("2023", "01", "boletin"),
+                                                      os.path.join("2023", "01", "boletin_2"),
+                                                      os.path.join("2023", "02", "boletin")])
+
+    def fake_process(client, path, name, *a, **kw):
+        return {"transcript_text": path, "corrected_segments": [{"start": 0, "end": 1, "text": path}],
+                "coverage_pct": 100.0}
+    monkeypatch.setattr(app, "process_audio", fake_process)
+    out = tmp_path / "out"
+    for path, rel in files: assert app.batch_process_file(None, path, _args(out), "", rel=rel)
+    for path, rel in files:
+        with open(os.path.join(out, f"{rel}.txt"), encoding="utf-8") as fp: assert fp.read() == path
+
+    calls = []
+    monkeypatch.setattr(app, "process_audio", lambda *a, **kw: calls.append(a) or fake_process(*a))
+    _touch(str(src / "2023" / "03" / "boletin.mp3"))
+    for path, rel in app.collect_audio_files([str(src)]):
+        app.batch_process_file(None, path, _args(out, skip_existing=True), "", rel=rel)
+    assert [c[1] for c in calls] == [str(src / "2023" / "03" / "boletin.mp3")]
+
+
+def test_glob_input_mirrors_from_fixed_prefix(tmp_path):
+    for month in ("01", "02"): _touch(str(tmp_path / "a" / month / "x.m4a"))
+    files = app.collect_audio_files([str(tmp_path / "a" / "*" / "*.m4a")])
+    assert [rel for _, rel in files] == [os.path.join("01", "x"), os.path.join("02", "x")]
@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+
+def _union(segments):
+    merged = []
+    for s, e in sorted((seg["start"], seg["end"]) for seg in segments):
+        if e <= s: continue
+        if merged and s <= merged[-1][1]: merged[-1][1] = max(merged[-1][1], e)
+        else: merged.append([s, e])
+    return merged
+
+
+def _ref_coverage(segments, total):
+    return min(100.0, sum(e - s for s, e in _union(segments)) / total * 100)
+
+
+def _ref_gaps(segments, lo, hi, threshold):
+    out, t = [], lo
+    for s, e in _union(segments):
+        if e <= lo or s >= hi: continue
+        if s - t > threshold: out.append((t, s))
+        t = max(t, e)
+    if hi - t > threshold: out.append((t, hi))
+    return out
+
+
+def _random_segments(rng, n, total):
+    segs = []
+    for _ in range(n):
+        s = rng.uniform(0, total); segs.append({"start": s, "end": min(total, s + rng.uniform(0, 12))})
+    return segs
+
+
+def test_coverage_index_matches_interval_union():
+    rng = random.Random(5)
+    for _ in range(50):
+        total = rng.uniform(60, 900); segs = _random_segments(rng, rng.randint(0, 120), total)
+        cover = app.CoverageIndex(segs)
+        assert abs(cover.coverage_pct(total) - _ref_coverage(segs, total)) < 1e-9
+        got = [(g["start"], g["end"]) for g in cover.gaps(0, total, threshold=2.0)]
+        assert got == _ref_gaps(segs, 0, total, 2.0)
+
+
+def test_incremental_adds_match_a_rebuilt_index():
+    rng = random.Random(11)
+    for _ in range(50):
+        total = 600.0; base = _random_segments(rng, 40, total); extra = _random_segments(rng, 40, total)
+        cover = app.CoverageIndex(base)
+        for seg in extra: cover.add(seg["start"], seg["end"])
+        rebuilt = app.CoverageIndex(base + extra)
+        assert (cover.starts, cover.ends) == (rebuilt.starts, rebuilt.ends)
+        assert abs(cover.covered - rebuilt.covered) < 1e-6
+        t = rng.uniform(0, total)
+        assert cover.covers(t) == any(s <= t <= e for s, e in _union(base + extra))
+
+
+def test_gaps_inside_a_range_only_look_at_that_range():
+    segs = [{"start": 0, "end": 10}, {"start": 30, "end": 40}, {"start": 70, "end": 80}]
+    cover = app.CoverageIndex(segs)
+    assert [(g["start"], g["end"]) for g in cover.gaps(35, 60, threshold=1.0)] == [(40, 60)]
+    assert cover.gaps(32, 38, threshold=1.0) == []
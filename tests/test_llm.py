@@ -0,0 +1,101 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from groq import RateLimitError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(app.time, "sleep", lambda s: now.__setitem__(0, now[0] + s))
+    return now
+
+
+def _starts(limiter, clock, tokens):
+    out = []
+    for t in tokens:
+        limiter.wait(t); out.append(round(clock[0] - 100.0, 3))
+    return out
+
+
+def test_rate_limiter_spaces_requests_per_minute(clock):
+    assert _starts(app.RateLimiter(60), clock, [0] * 4) == [0, 1, 2, 3]
+
+
+def test_rate_limiter_token_bucket_waits_for_refill(clock):
+    # 600 tokens por minuto = 10 por segundo; la cubeta empieza llena
+    assert _starts(app.RateLimiter(0, 600), clock, [300, 300, 300, 300]) == [0, 0, 30, 60]
+
+
+def test_rate_limiter_pause_delays_next_request(clock):
+    limiter = app.RateLimiter(0, 0)
+    limiter.pause(12)
+    assert _starts(limiter, clock, [0]) == [12]
+
+
+def _rate_limit_error():
+    request = httpx.Request("POST", "https://api.groq.com")
+    return RateLimitError("429", response=httpx.Response(429, headers={"retry-after": "2"}, request=request), body=None)
+
+
+def test_limited_retries_rate_limits_then_gives_up(clock):
+    calls = []
+    def flaky(fail):
+        calls.append(clock[0])
+        if len(calls) <= fail: raise _rate_limit_error()
+        return "ok"
+    assert app._limited(app.RateLimiter(0, 0), flaky, 2) == "ok"
+    assert [round(t - calls[0]) for t in calls] == [0, 2, 4]
+    calls.clear()
+    with pytest.raises(RateLimitError): app._limited(app.RateLimiter(0, 0), flaky, app.LLM_RETRIES + 1)
+    assert len(calls) == app.LLM_RETRIES + 1
+
+
+def test_llm_chat_reserves_sent_text_plus_max_tokens():
+    reserved = []
+    limiter = SimpleNamespace(wait=reserved.append, pause=lambda s: None)
+    message = SimpleNamespace(content="ok")
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        create=lambda **kw: SimpleNamespace(choices=[SimpleNamespace(message=message)]))))
+    system, text = "Resume.", "palabra " * 6000
+    app.ai_generate(client, system, text[:12000], max_tokens=2048, limiter=limiter)
+    assert reserved == [app.estimate_tokens(system) + app.estimate_tokens(text[:12000]) + 2048]
+
+
+def _text(n_sentences, words_per_sentence=12, punct=True):
+    words = "la reforma de la salud llega al concejo esta semana con cambios en el presupuesto".split()
+    sents = [" ".join(words[(i + k) % len(words)] for k in range(words_per_sentence)) for i in range(n_sentences)]
+    return (". ".join(sents) + ".") if punct else " ".join(sents)
+
+
+@pytest.mark.parametrize("text", [_text(800), _text(800, punct=False), _text(3, words_per_sentence=3000)])
+def test_split_text_blocks_never_exceeds_budget(text):
+    blocks = app.split_text_blocks(text, budget=500)
+    assert len(blocks) > 1
+    assert all(app.estimate_tokens(b) <= 500 for b in blocks)
+    assert " ".join(blocks).split() == text.split()
+
+
+def test_split_text_blocks_cuts_at_segment_ends():
+    units = [_text(1, words_per_sentence=n) for n in (5, 40, 80, 7, 120, 33) * 20]
+    blocks = app.split_text_blocks(" ".join(units), budget=400, units=units)
+    assert all(app.estimate_tokens(b) <= 400 for b in blocks)
+    starts = {0}
+    for u in units: starts.add(max(starts) + len(u.split()))
+    pos = 0
+    for b in blocks: assert pos in starts; pos += len(b.split())
+
+
+def test_pack_blocks_is_contiguous_and_balanced():
+    units = ["x" * 299] * 25  # 100 tokens cada una
+    blocks = app.pack_blocks(units, budget=1000)
+    assert [i for b in blocks for i in b] == list(range(25))
+    # Tres bloques parecidos en vez de 10 + 10 + 5
+    assert len(blocks) == 3 and all(700 <= 100 * len(b) <= 1000 for b in blocks)
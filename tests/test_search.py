@@ -0,0 +1,135 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+WORDS = ("El alcalde de Medellín habló de la reforma, la alcaldía y el Concejo; según él, "
+         "la economía creció. ¿Seguridad? Sí: más policías en la comuna 13 y menos reformas.").split()
+
+
+def _segments(rng, n=120):
+    return [{"start": 4.0 * i, "end": 4.0 * i + 4, "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 10)))}
+            for i in range(n)]
+
+
+def _old_exact(query, segments):
+    """Búsqueda exacta anterior al índice: subcadena sobre cada ventana de palabras y, si no hay, por palabra."""
+    q_norm = app.norm(query); q_words = q_norm.split()
+    words = [(w, si) for si, seg in enumerate(segments) for w in seg["text"].split()]
+    sn = [app.norm(w) for w, _ in words]
+    found = [i for i in range(len(sn) - len(q_words) + 1) if q_norm in " ".join(sn[i:i + len(q_words)])]
+    if not found: found = [i for i, wn in enumerate(sn) if any(len(qw) > 2 and qw in wn for qw in q_words)]
+    return found, {words[i][1] for i in found}
+
+
+def _queries(rng, segments):
+    words = [w for seg in segments for w in seg["text"].split()]
+    out = ["alcaldia", "medellin habló", "REFORMA", "orma", "de la", "la alcaldía y", "comuna 13", "nada de esto"]
+    for _ in range(150):
+        i, n = rng.randrange(len(words)), rng.randint(1, 3)
+        q = " ".join(words[i:i + n])
+        if rng.random() < 0.5: q = q[rng.randint(0, 2):len(q) - rng.randint(0, 2)]
+        out.append(q)
+    return [q for q in out if app.norm(q).split()]
+
+
+def test_index_search_matches_the_linear_scan():
+    rng = random.Random(2)
+    for _ in range(5):
+        segs = _segments(rng); ix = app.TranscriptIndex(segs)
+        for q in _queries(rng, segs):
+            positions, seg_ids = _old_exact(q, segs)
+            q_words = app.norm(q).split()
+            got = ix.phrase(q_words) or sorted(
+                {p for qw in q_words if len(qw) > 2 for p in ix.positions(ix.terms_containing(qw))})
+            assert got == positions, q
+            res = app.search_segments(q, segs, None, fuzzy_thresh=1.0, index=ix)
+            assert {r["idx"] for r in res} == seg_ids, q
+
+
+def _levenshtein(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1): cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def test_bounded_edit_distance_matches_levenshtein():
+    rng = random.Random(4)
+    for _ in range(3000):
+        a = "".join(rng.choice("abcde") for _ in range(rng.randint(0, 9)))
+        b = "".join(rng.choice("abcde") for _ in range(rng.randint(0, 9)))
+        d, k = _levenshtein(a, b), rng.randint(0, 4)
+        assert app.bounded_edit_distance(a, b, k) == (d if d <= k else k + 1)
+
+
+def test_similar_terms_match_a_brute_force_scan():
+    rng = random.Random(6)
+    segs = _segments(rng, 300); ix = app.TranscriptIndex(segs)
+    cores = {t: t.strip(app._WORD_PUNCT) for t in ix.vocab}; hits = 0
+    for q in ["alcadia", "medelin", "refroma", "economia", "concejo", "segurida", "policia", "comunas", "xyzzy", "el"]:
+        for thresh in (0.6, 0.75, 0.9):
+            if len(q) < 3: want = {t: 1.0 for t, c in cores.items() if c == q}
+            else:
+                sims = {t: 1 - _levenshtein(q, c) / max(len(q), len(c)) for t, c in cores.items()}
+                want = {t: sc for t, sc in sims.items() if sc >= thresh}
+            got = ix.similar_terms(q, thresh)
+            assert got.keys() == want.keys(), (q, thresh)
+            assert all(abs(got[t] - want[t]) < 1e-9 for t in want)
+            hits += len(want)
+    assert hits > 20
+
+
+def test_fuzzy_search_finds_misspelled_phrases_and_words():
+    segs = [{"start": 0.0, "end": 4.0, "text": "El alcalde de Medellín habló hoy."},
+            {"start": 4.0, "end": 8.0, "text": "La alcaldía respondió al Concejo."}]
+    assert [r["idx"] for r in app.search_segments("alcadia", segs, None)] == [1]
+    assert [r["idx"] for r in app.search_segments("alcalde de medelin", segs, None)] == [0]
+    assert {r["idx"] for r in app.search_segments("alcadia medelin", segs, None)} == {0, 1}
+    assert app.search_segments("alcadia", segs, None, fuzzy_thresh=1.0) == []
+
+
+def _save(aid, name, *texts):
+    segs = [{"start": 4.0 * i, "end": 4.0 * i + 4, "text": t} for i, t in enumerate(texts)]
+    app.history_save(aid, {"uploaded_filename": name, "transcript_segments": segs, "corrected_segments": segs,
+                           "transcript_text": " ".join(texts)}, with_segments=True)
+
+
+def _fts_state():
+    with app.closing(app.history_db()) as con:
+        con.execute("INSERT INTO search_fts (search_fts) VALUES ('integrity-check')")
+        rows = con.execute("SELECT audio_id, idx, text FROM search_rows ORDER BY audio_id, idx").fetchall()
+    return [tuple(r) for r in rows]
+
+
+def test_fts_index_follows_saves_and_deletes(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_DB", str(tmp_path / "h.db"))
+    monkeypatch.setattr(app, "_history_ready", False)
+    _save("a1", "pleno.mp3", "El alcalde de Medellín habló.", "La reforma llega al Concejo.")
+    _save("a2", "radio.mp3", "Entrevista sobre la reforma tributaria.")
+    assert {(r["audio_id"], r["idx"]) for r in app.global_search("reforma", 1.0)} == {("a1", 1), ("a2", 0)}
+    assert [r["audio_name"] for r in app.global_search("medellin", 1.0)] == ["pleno.mp3"]
+
+    # Volver a guardar reemplaza las filas del índice: el texto viejo deja de aparecer
+    _save("a1", "pleno.mp3", "El alcalde de Bello habló.")
+    assert app.global_search("medellin", 1.0) == []
+    assert [(r["audio_id"], r["idx"]) for r in app.global_search("bello", 1.0)] == [("a1", 0)]
+    assert _fts_state() == [("a1", 0, "El alcalde de Bello habló."), ("a2", 0, "Entrevista sobre la reforma tributaria.")]
+
+    app.history_delete("a2")
+    assert app.global_search("reforma", 1.0) == []
+    assert _fts_state() == [("a1", 0, "El alcalde de Bello habló.")]
+
+
+def test_fts_backfills_an_existing_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_DB", str(tmp_path / "h.db"))
+    monkeypatch.setattr(app, "_history_ready", False)
+    _save("a1", "pleno.mp3", "La economía creció en Medellín.")
+    with app.closing(app.history_db()) as con, con:
+        con.execute("DELETE FROM search_rows")  # base de antes del índice
+    monkeypatch.setattr(app, "_history_ready", False)
+    assert [r["audio_id"] for r in app.global_search("economia", 1.0)] == ["a1"]
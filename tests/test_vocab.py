@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app_estable as app  # noqa: E402
+
+VOCAB = ["Medellín", "Bedout", "Bello", "Casablanca", "Gustavo Petro"]
+
+
+def _apply(*texts):
+    segs = [{"start": float(i), "end": float(i + 1), "text": t} for i, t in enumerate(texts)]
+    out, doubtful = app.apply_vocab_matcher(segs, VOCAB)
+    return [s["text"] for s in out], doubtful
+
+
+def test_accent_case_and_spacing_fixes_apply_to_capitalized_names():
+    texts, doubtful = _apply("La reunión fue en Medellin con el alcalde.",
+                             "Habló el presidente Gustavo petro esta mañana.",
+                             "El técnico Bed out llegó tarde.")
+    assert texts == ["La reunión fue en Medellín con el alcalde.",
+                     "Habló el presidente Gustavo Petro esta mañana.",
+                     "El técnico Bedout llegó tarde."]
+    assert doubtful == []
+
+
+def test_lowercase_and_sentence_start_words_are_left_to_the_model():
+    texts, doubtful = _apply("la reunión fue en medellin ayer", "Medellin amaneció con lluvia.")
+    assert texts == ["la reunión fue en medellin ayer", "Medellin amaneció con lluvia."]
+    assert doubtful == [0, 1]
+
+
+def test_phonetic_only_matches_are_never_applied():
+    texts, doubtful = _apply("Visitamos el barrio Vello y la playa de Cazablanca.")
+    assert texts == ["Visitamos el barrio Vello y la playa de Cazablanca."]
+    assert doubtful == [0]
+
+
+def test_common_words_are_never_replaced():
+    texts, doubtful = _apply("Un paisaje muy bello en la casa blanca.", "Llegamos a Belló por la tarde.")
+    assert texts[0] == "Un paisaje muy bello en la casa blanca."
+    # "bello" aparece en minúscula en la transcripción: la mayúscula no basta para aplicarlo sin modelo
+    assert texts[1] == "Llegamos a Belló por la tarde."
+    assert doubtful == [0, 1]